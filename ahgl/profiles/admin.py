@@ -24,6 +24,9 @@ class TeamMembershipAdminInline(admin.TabularInline):
         HTMLField: {'widget': TinyMCE(mce_attrs={'theme': 'advanced'})},
     }
 
+    def queryset(self, request):
+        return super(TeamMembershipAdminInline, self).queryset(request).roster()
+
 
 class TeamMembershipAdmin(admin.ModelAdmin):
     list_display = ('__unicode__', 'active', 'captain',)
@@ -33,6 +36,10 @@ class TeamMembershipAdmin(admin.ModelAdmin):
         HTMLField: {'widget': TinyMCE(mce_attrs={'theme': 'advanced'})},
     }
 
+    def queryset(self, request):
+        # the change page loads questions_answers on access, the changelist never needs it
+        return super(TeamMembershipAdmin, self).queryset(request).roster()
+
 
 class ProfileAdmin(admin.ModelAdmin):
     list_display = ('__unicode__', )
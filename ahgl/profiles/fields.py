@@ -2,17 +2,47 @@ import bleach
 
 from django.conf import settings
 from django.db import models
-from django.utils.safestring import mark_safe
+from django.db.models.signals import class_prepared, post_init
+from django.utils.safestring import SafeData, mark_safe
 
 from tinymce.widgets import TinyMCE
 
 
+class HTMLDescriptor(object):
+    """Values loaded from the database were cleaned when they were saved, so
+    they are marked safe when first read. Values assigned since (or given to a
+    new instance) stay plain text, and are escaped, until saving cleans them."""
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            raise AttributeError('Can only be accessed via an instance.')
+        value = instance.__dict__[self.field.attname]
+        if value and not isinstance(value, SafeData) and not instance._state.adding and \
+                self.field.attname not in instance.__dict__.get('_html_assigned', ()):
+            value = instance.__dict__[self.field.attname] = mark_safe(value)
+        return value
+
+    def __set__(self, instance, value):
+        value = self.field.to_python(value)
+        if isinstance(value, SafeData):
+            instance.__dict__.get('_html_assigned', set()).discard(self.field.attname)
+        elif instance.__dict__.get('_html_initialized'):
+            instance.__dict__.setdefault('_html_assigned', set()).add(self.field.attname)
+        instance.__dict__[self.field.attname] = value
+
+
+def html_initialized(sender, instance, **kwargs):
+    # assignments before this are the row being loaded, or the constructor arguments
+    instance.__dict__['_html_initialized'] = True
+
+
 class HTMLField(models.TextField):
     """This stores HTML content to be displayed raw to the user.
-    The content is cleaned using bleach to restrict the set of HTML used.
+    The content is cleaned using bleach to restrict the set of HTML used
+    when it is saved, so stored values are trusted when they are loaded.
     The TinyMCE widget is used for form editing."""
-    __metaclass__ = models.SubfieldBase
-
     def __init__(self, tags=None, attributes=None, *args, **kwargs):
         self.tags = tags
         self.attributes = attributes
@@ -33,12 +63,30 @@ class HTMLField(models.TextField):
         defaults.update(kwargs)
         return super(HTMLField, self).formfield(**defaults)
 
-    def to_python(self, value):
-        value = super(HTMLField, self).to_python(value)
+    def sanitize(self, value):
         value = bleach.clean(value, tags=self.tags, attributes=self.attributes, strip=True)
         value = bleach.linkify(value)
         return mark_safe(value)
 
+    def contribute_to_class(self, cls, name):
+        super(HTMLField, self).contribute_to_class(cls, name)
+        setattr(cls, self.name, HTMLDescriptor(self))
+
+    def pre_save(self, model_instance, add):
+        value = getattr(model_instance, self.attname)
+        if value:
+            value = self.sanitize(value)
+            setattr(model_instance, self.attname, value)
+        return value
+
+
+def connect_html_initialized(sender, **kwargs):
+    # per model with an HTMLField, deferred subclasses included, rather than
+    # on every instance of every model
+    if any(isinstance(field, HTMLField) for field in sender._meta.fields):
+        post_init.connect(html_initialized, sender=sender, dispatch_uid='profiles_html_initialized')
+class_prepared.connect(connect_html_initialized, dispatch_uid='profiles_connect_html_initialized')
+
 try:
     from south.modelsinspector import add_introspection_rules
     rules = [(
@@ -1,19 +1,47 @@
 # coding=utf8
 from __future__ import print_function
 
-from django.core.management.base import BaseCommand
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max, Min
 
 from django.contrib.auth.models import User
+from account.models import EmailAddress
 
 
 class Command(BaseCommand):
     args = ''
     help = 'Clears all emails from user profiles'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+                    type='int',
+                    dest='batch_size',
+                    default=5000,
+                    help='Number of user ids cleared per statement'),
+        make_option('--email-addresses',
+                    action='store_true',
+                    dest='email_addresses',
+                    default=False,
+                    help='Also delete the EmailAddress rows of the users'),
+    )
 
     def handle(self, *args, **options):
-        for user in User.objects.all():
-            try:
-                user.email = ""
-                user.save()
-            except Exception:
-                pass
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be at least 1")
+        bounds = User.objects.aggregate(first=Min('pk'), last=Max('pk'))
+        if bounds['first'] is None:
+            return
+        batch_size = options['batch_size']
+        users = addresses = 0
+        # update() skips save() and the post_save receivers, which only matter for real edits
+        for start in xrange(bounds['first'], bounds['last'] + 1, batch_size):
+            with transaction.commit_on_success():
+                users += User.objects.filter(pk__gte=start, pk__lt=start + batch_size).exclude(email="").update(email="")
+                if options['email_addresses']:
+                    batch = EmailAddress.objects.filter(user__gte=start, user__lt=start + batch_size)
+                    addresses += batch.count()
+                    batch.delete()
+            print("{0}/{1}: {2} emails cleared, {3} email addresses deleted".format(
+                min(start + batch_size - 1, bounds['last']), bounds['last'], users, addresses), file=self.stdout)
@@ -0,0 +1,64 @@
+# coding=utf8
+from __future__ import print_function
+
+from multiprocessing import Pool
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import get_model
+
+from utils.thumbnails import THUMBNAIL_SPECS, generate_thumbnails
+
+
+def images():
+    """Yields (app_label, model name, pk, field names) of every row with a registered image"""
+    for model, specs in THUMBNAIL_SPECS.items():
+        names = list(specs)
+        for row in model._default_manager.order_by('pk').values_list('pk', *names).iterator():
+            present = [name for name, value in zip(names, row[1:]) if value]
+            if present:
+                yield model._meta.app_label, model._meta.object_name, row[0], present
+
+
+def init_worker():
+    # forked workers must not share the parent's database connection
+    connection.close()
+
+
+def generate(args):
+    """Generates the thumbnails of one row. Returns (args, error)"""
+    app_label, model_name, pk, names = args
+    model = get_model(app_label, model_name)
+    try:
+        generate_thumbnails(model._default_manager.get(pk=pk), names)
+    except Exception as e:
+        return args, repr(e)
+    return args, None
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Generates every registered thumbnail size of all existing images, so pages never render them inline'
+    option_list = BaseCommand.option_list + (
+        make_option('--workers',
+                    type='int',
+                    dest='workers',
+                    default=4,
+                    help='Number of worker processes running PIL'),
+    )
+
+    def handle(self, *args, **options):
+        rows = list(images())
+        print("Generating thumbnails of {0} rows".format(len(rows)), file=self.stdout)
+        connection.close()
+        pool = Pool(processes=options['workers'], initializer=init_worker)
+        try:
+            for done, ((app_label, model_name, pk, names), error) in enumerate(pool.imap_unordered(generate, rows), 1):
+                if error:
+                    print("Could not generate {0}.{1} {2} {3}: {4}".format(app_label, model_name, pk, ", ".join(names), error), file=self.stderr)
+                if done % 100 == 0:
+                    print("{0}/{1}".format(done, len(rows)), file=self.stdout)
+        finally:
+            pool.close()
+            pool.join()
@@ -0,0 +1,33 @@
+# coding=utf8
+from __future__ import print_function
+
+import cPickle as pickle
+
+from django.core.management.base import BaseCommand, CommandError
+
+from tournaments.models import Tournament
+from profiles.models import Team, TeamMembership
+
+
+class Command(BaseCommand):
+    args = '<tournament_slug>'
+    help = 'Compares the bytes loaded by the hot list queries with and without the lean projections'
+
+    def handle(self, *args, **options):
+        try:
+            tournament = Tournament.objects.get(slug=args[0])
+        except (IndexError, Tournament.DoesNotExist):
+            raise CommandError("Give an existing tournament slug")
+
+        memberships = TeamMembership.objects.filter(team__tournament=tournament)
+        teams = Team.objects.filter(tournament=tournament)
+        pages = (
+            ("mvp", memberships.select_related('team', 'profile'), memberships.card()),
+            ("team rosters", memberships.select_related('profile'), memberships.roster().select_related('profile')),
+            ("player choices", memberships, memberships.choice()),
+            ("team choices", teams, teams.choice()),
+            ("team cards", teams, teams.card()),
+        )
+        for name, full, lean in pages:
+            full_size, lean_size = len(pickle.dumps(list(full), -1)), len(pickle.dumps(list(lean), -1))
+            print("{0}: {1} bytes before, {2} bytes after ({3:.0%})".format(name, full_size, lean_size, float(lean_size) / (full_size or 1)), file=self.stdout)
@@ -0,0 +1,86 @@
+# coding=utf8
+from __future__ import print_function
+
+import time
+from functools import partial
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import get_models
+
+from profiles.fields import HTMLField
+
+
+def html_fields():
+    for model in get_models():
+        for field in model._meta.fields:
+            if isinstance(field, HTMLField):
+                yield model, field
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Re-sanitizes the stored contents of every HTMLField, since they are no longer cleaned on load'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size',
+                    type='int',
+                    dest='batch_size',
+                    default=500,
+                    help='Number of rows read and written per transaction'),
+        make_option('--benchmark',
+                    action='store_true',
+                    dest='benchmark',
+                    default=False,
+                    help='Only report the per row cost of loading each field with and without sanitizing'),
+    )
+
+    def handle(self, *args, **options):
+        for model, field in html_fields():
+            if options['benchmark']:
+                self.benchmark(model, field, options['batch_size'])
+            else:
+                self.sanitize(model, field, options['batch_size'])
+
+    def rows(self, model, field, batch_size):
+        """Yields lists of (pk, value), walking the table by primary key"""
+        queryset = model._default_manager.order_by('pk').values_list('pk', field.attname)
+        last_pk = None
+        while True:
+            batch = list((queryset.filter(pk__gt=last_pk) if last_pk is not None else queryset)[:batch_size])
+            if not batch:
+                return
+            last_pk = batch[-1][0]
+            yield batch
+
+    def sanitize(self, model, field, batch_size):
+        seen = changed = 0
+        for batch in self.rows(model, field, batch_size):
+            with transaction.commit_on_success():
+                for pk, value in batch:
+                    clean = field.sanitize(value) if value else value
+                    if clean != value:
+                        # update() skips pre_save and the post_save receivers
+                        model._default_manager.filter(pk=pk).update(**{field.attname: clean})
+                        changed += 1
+            seen += len(batch)
+            print("{0}.{1}: {2} rows checked, {3} changed".format(model.__name__, field.name, seen, changed), file=self.stdout)
+
+    def load(self, model, field, value):
+        """Builds an instance the way a queryset does and reads the field
+        through its descriptor, which marks the stored value safe"""
+        instance = model(**{field.attname: value})
+        instance._state.adding = False
+        return getattr(instance, field.attname)
+
+    def benchmark(self, model, field, batch_size):
+        values = [value for batch in self.rows(model, field, batch_size) for pk, value in batch if value]
+        if not values:
+            return
+        results = []
+        for label, load in (("sanitize on load", field.sanitize), ("trusted load", partial(self.load, model, field))):
+            start = time.time()
+            for value in values:
+                load(value)
+            results.append("{0} {1:.1f}us/row".format(label, (time.time() - start) / len(values) * 1e6))
+        print("{0}.{1} ({2} rows): {3}".format(model.__name__, field.name, len(values), ", ".join(results)), file=self.stdout)
@@ -1,15 +1,19 @@
-import urllib2
 import logging
+import operator
 
-from django.core.files.base import ContentFile
+from django.core.cache import cache
 from django.db import models
+from django.db.models import Count, Q
+from django.db.models.query import QuerySet
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
 from django.dispatch import receiver
+from django.db.models.signals import post_save, post_delete
 from django.contrib.auth.models import User
 from django.db import IntegrityError, transaction
 from django.template.defaultfilters import slugify
 
+from celery.execute import send_task
 from social_auth.signals import socialauth_registered
 from social_auth.backends.facebook import FacebookBackend
 from social_auth.backends.pipeline import USERNAME
@@ -23,12 +27,20 @@ if "sorl.thumbnail" in settings.INSTALLED_APPS:
 else:
     from django.db.models import ImageField
 
+from utils.modelcache import ModelCache
+from utils.thumbnails import pregenerate
+from utils.versions import bump_versions
+
 from . import RACES
 from .fields import HTMLField
-from tournaments.models import Game
+from tournaments.models import (Game, Match, delete_receiver_deferred, team_ids_cache_key,
+                                team_version_key, tournament_version_key)
 
 logger = logging.getLogger(__name__)
 
+CAPTAIN_DASHBOARD_CACHE_SECONDS = getattr(settings, 'CAPTAIN_DASHBOARD_CACHE_SECONDS', 60 * 5)
+OPEN_MATCH_QUEUE_CACHE_SECONDS = getattr(settings, 'OPEN_MATCH_QUEUE_CACHE_SECONDS', 60 * 60)
+
 
 class Profile(PybbProfile):
     user = models.ForeignKey(User, verbose_name=_("user"), related_name="profile")
@@ -86,29 +98,82 @@ class Profile(PybbProfile):
     def get_form(cls):
         return get_profile_form(cls)
 
+    @classmethod
+    def allocate_slugs(cls, profiles):
+        """
+        Sets a unique slug on each of the unsaved ``profiles``, appending _1, _2, ...
+        to taken ones. All existing slugs sharing a prefix are fetched in one query,
+        so this can be used before bulk_create for imports. A name with nothing to
+        slugify (Hangul, say) falls back to the username, then to "player".
+        """
+        profiles = list(profiles)
+        bases = [slugify(profile.name) or slugify(profile.user.username) or "player" for profile in profiles]
+        taken = set()
+        if bases:
+            prefixes = reduce(operator.or_, (models.Q(slug__startswith=base) for base in set(bases)))
+            taken.update(cls.objects.filter(prefixes).values_list('slug', flat=True))
+        for profile, base in zip(profiles, bases):
+            slug, i = base, 0
+            while slug in taken:
+                i += 1
+                slug = '%s_%d' % (base, i)
+            taken.add(slug)
+            profile.slug = slug
+        return profiles
+
     def save(self, *args, **kwargs):
         """
-        Based on the Tag save() method in django-taggit, this method simply
-        stores a slugified version of the title, ensuring that the unique
-        constraint is observed
+        Stores a unique slugified version of the name on creation. The slug is
+        picked from the existing ones in a single query; if another profile
+        takes it before the insert, it is picked once more and retried.
         """
         if self.id is None:
-            self.slug = slug = slugify(self.name or self.user.username)
-            i = 0
-            while True:
-                try:
-                    savepoint = transaction.savepoint()
-                    res = super(Profile, self).save(*args, **kwargs)
-                    transaction.savepoint_commit(savepoint)
-                    return res
-                except IntegrityError:
-                    transaction.savepoint_rollback(savepoint)
-                    i += 1
-                    self.slug = '%s_%d' % (slug, i)
+            self.allocate_slugs([self])
+            try:
+                savepoint = transaction.savepoint()
+                res = super(Profile, self).save(*args, **kwargs)
+                transaction.savepoint_commit(savepoint)
+                return res
+            except IntegrityError:
+                transaction.savepoint_rollback(savepoint)
+                self.allocate_slugs([self])
+                return super(Profile, self).save(*args, **kwargs)
         else:
             return super(Profile, self).save(*args, **kwargs)
 
 
+class TeamMembershipQuerySet(QuerySet):
+    """Named projections that leave out the questions_answers blob"""
+    def roster(self):
+        """Full membership rows without the bio"""
+        return self.defer('questions_answers')
+
+    def choice(self):
+        """Just enough to label a membership in a form field"""
+        return self.only('char_name')
+
+    def card(self):
+        """A player as shown in lists, with links to the team and profile"""
+        return self.select_related('team__tournament', 'profile') \
+                   .only('char_name', 'active', 'captain', 'race', 'champion', 'char_code',
+                         'team__name', 'team__slug', 'team__tournament__name',
+                         'profile__name', 'profile__slug', 'profile__photo', 'profile__custom_thumb', 'profile__user')
+
+
+class TeamMembershipManager(models.Manager):
+    def get_query_set(self):
+        return TeamMembershipQuerySet(self.model, using=self._db)
+
+    def roster(self):
+        return self.get_query_set().roster()
+
+    def choice(self):
+        return self.get_query_set().choice()
+
+    def card(self):
+        return self.get_query_set().card()
+
+
 class TeamMembership(models.Model):
     """All team specific profile data goes here"""
     #M2M data
@@ -165,6 +230,8 @@ class TeamMembership(models.Model):
     #league of legends data
     champion = models.CharField(max_length=60, blank=True)
 
+    objects = TeamMembershipManager()
+
     @classmethod
     def get(self, team, tournament, profile):
         return TeamMembership.objects.select_related('team', 'profile') \
@@ -210,6 +277,30 @@ class TeamMembership(models.Model):
         ordering = ('-active', '-captain', 'char_name',)
 
 
+class TeamQuerySet(QuerySet):
+    """Named projections that leave out the approval and photo files"""
+    def choice(self):
+        """Just enough to label and link a team"""
+        return self.select_related('tournament').only('name', 'slug', 'tournament__name')
+
+    def card(self):
+        """A team as shown in lists and standings"""
+        return self.select_related('tournament') \
+                   .only('name', 'slug', 'photo', 'wins', 'losses', 'tiebreaker', 'seed', 'karma', 'status',
+                         'tournament__name')
+
+
+class TeamManager(models.Manager):
+    def get_query_set(self):
+        return TeamQuerySet(self.model, using=self._db)
+
+    def choice(self):
+        return self.get_query_set().choice()
+
+    def card(self):
+        return self.get_query_set().card()
+
+
 class Team(models.Model):
     """Per Tournament"""
     name = models.CharField(_("company name"), max_length=50)
@@ -231,6 +322,8 @@ class Team(models.Model):
     status = models.CharField(max_length=1, choices=(('R', 'Registering'), ('W', 'Awaiting Approval'), ('A', 'Accepted'), ('F', 'Finalized')), default='R')
     paid = models.BooleanField(default=False)
 
+    objects = TeamManager()
+
     def update_stats(self):
         self.wins = self.match_wins.filter(published=True).count()
         self.losses = self.match_losses.filter(published=True).count()
@@ -241,9 +334,26 @@ class Team(models.Model):
     def thumbnail(self):
         return self.photo
 
+    def load_roster(self):
+        """Loads the members with their profiles and published game records
+        (``win_count``/``loss_count``) in three queries. The membership
+        properties below then read the loaded roster instead of querying."""
+        members = list(self.team_membership.roster().select_related('profile')
+                                           .extra(select={'lower_char_name': 'lower(char_name)'})
+                                           .order_by('-active', '-captain', 'lower_char_name'))
+        games = Game.objects.filter(match__published=True).order_by()
+        wins = dict(games.filter(winner__team=self).values_list('winner').annotate(Count('pk')))
+        losses = dict(games.filter(loser__team=self).values_list('loser').annotate(Count('pk')))
+        for member in members:
+            member.win_count = wins.get(member.pk, 0)
+            member.loss_count = losses.get(member.pk, 0)
+        self._team_membership_queryset = members
+        self.member_count = len(members)
+        return members
+
     @property
     def membership_queryset(self):
-        self._team_membership_queryset = getattr(self, '_team_membership_queryset', None) or self.team_membership.select_related('profile').extra(select={'lower_char_name': 'lower(char_name)'}).order_by('-active', '-captain', 'lower_char_name')
+        self._team_membership_queryset = getattr(self, '_team_membership_queryset', None) or self.team_membership.roster().select_related('profile').extra(select={'lower_char_name': 'lower(char_name)'}).order_by('-active', '-captain', 'lower_char_name')
         return self._team_membership_queryset
 
     @property
@@ -261,6 +371,8 @@ class Team(models.Model):
 
     @property
     def has_minimum_members(self):
+        if hasattr(self, 'member_count'):
+            return self.member_count >= 8
         return self.team_membership.count() >= 8
 
     def __unicode__(self):
@@ -292,6 +404,10 @@ class Charity(models.Model):
         verbose_name_plural = "charities"
 
 
+team_cache = ModelCache(Team, lookups=[('tournament', 'slug')])
+charity_cache = ModelCache(Charity)
+
+
 class Caster(models.Model):
     user = models.ForeignKey(User, verbose_name=_("user"), related_name="caster_profile")
     tournament = models.ForeignKey('tournaments.Tournament', related_name="casters")
@@ -304,6 +420,176 @@ class Caster(models.Model):
         return u" ".join((unicode(self.tournament), unicode(self.user)))
 
 
+PROFILE_ITEM = ("150x170", {'crop': "center"})
+PROFILE_PHOTO = ("352x450", {'upscale': False})
+pregenerate(Profile, photo=(PROFILE_PHOTO, PROFILE_ITEM), custom_thumb=(PROFILE_ITEM,))
+pregenerate(Team, photo=(("920x450", {}), ("214x120", {'crop': "center"})))
+pregenerate(Caster, photo=(PROFILE_PHOTO,))
+pregenerate(Charity, logo=(("300x300", {}),))
+
+
+def caster_ids_cache_key(tournament_id):
+    return ":".join(("tournament_caster_ids", unicode(tournament_id)))
+
+
+def captain_dashboard_cache_key(user_id):
+    return ":".join(("captain_dashboard", unicode(user_id)))
+
+
+def open_match_queue_cache_key(user_id):
+    return ":".join(("open_match_queue", unicode(user_id)))
+
+
+def captain_dashboard(user):
+    """Returns a dict of the teams ``user`` captains, their memberships and
+    their unpublished matches, loaded in three queries and cached per user.
+    Each match gets ``lineup_submitted`` for the captain's side."""
+    key = captain_dashboard_cache_key(user.pk)
+    dashboard = cache.get(key)
+    if dashboard is None:
+        teams = list(Team.objects.choice().filter(team_membership__profile__user=user, team_membership__captain=True).distinct())
+        team_ids = set(team.pk for team in teams)
+        memberships, matches = [], []
+        if team_ids:
+            memberships = list(TeamMembership.objects.card().filter(team__in=team_ids).order_by('team__id', 'char_name'))
+            matches = list(Match.objects.filter(Q(home_team__in=team_ids) | Q(away_team__in=team_ids), published=False)
+                                        .select_related('tournament', 'home_team', 'away_team')
+                                        .only('tournament__name', 'home_team__name', 'away_team__name', 'creation_date', 'publish_date', 'home_submitted', 'away_submitted')
+                                        .order_by('creation_date'))
+            for match in matches:
+                match.lineup_submitted = match.home_submitted if match.home_team_id in team_ids else match.away_submitted
+        dashboard = {'teams': teams, 'memberships': memberships, 'matches': matches}
+        cache.set(key, dashboard, CAPTAIN_DASHBOARD_CACHE_SECONDS)
+    return dashboard
+
+
+def clear_captain_dashboards(team_ids, profile_id=None):
+    """Drops the cached dashboards of the captains of ``team_ids``, and of the
+    profile whose membership changed, since it may have just lost its captaincy."""
+    lookup = Q(team_membership__team__in=team_ids, team_membership__captain=True)
+    if profile_id is not None:
+        lookup |= Q(pk=profile_id)
+    user_ids = set(Profile.objects.filter(lookup).values_list('user', flat=True))
+    cache.delete_many([captain_dashboard_cache_key(user_id) for user_id in user_ids])
+
+
+def open_match_queue(user):
+    """Returns the unpublished matches ``user`` has something to do for, newest
+    first, loaded in two queries and cached per user. Each match gets ``role``,
+    the side the user plays on ('home' or 'away', None for matches of their
+    tournaments they may only report) and ``pending``: 'lineup' while their
+    side has not submitted, 'opponent' while the other side has not and
+    'report' once both lineups are in."""
+    key = open_match_queue_cache_key(user.pk)
+    queue = cache.get(key)
+    if queue is None:
+        queue = []
+        teams = list(TeamMembership.objects.filter(profile__user=user).values_list('team', 'team__tournament'))
+        team_ids = set(team for team, tournament in teams)
+        if team_ids:
+            queue = list(Match.objects.filter(Q(home_team__in=team_ids) | Q(away_team__in=team_ids) | Q(home_submitted=True, away_submitted=True),
+                                              tournament__in=set(tournament for team, tournament in teams), published=False)
+                                      .select_related('home_team', 'away_team')
+                                      .order_by('-creation_date'))
+            for match in queue:
+                match.role = 'home' if match.home_team_id in team_ids else 'away' if match.away_team_id in team_ids else None
+                if match.home_submitted and match.away_submitted:
+                    match.pending = 'report'
+                elif getattr(match, match.role + '_submitted'):
+                    match.pending = 'opponent'
+                else:
+                    match.pending = 'lineup'
+        cache.set(key, queue, OPEN_MATCH_QUEUE_CACHE_SECONDS)
+    return queue
+
+
+def clear_open_match_queues(tournament_ids):
+    """Drops the cached queues of every member of the teams of ``tournament_ids``;
+    any of them may report the tournament's matches."""
+    user_ids = set(Profile.objects.filter(teams__tournament__in=tournament_ids).values_list('user', flat=True))
+    cache.delete_many([open_match_queue_cache_key(user_id) for user_id in user_ids])
+
+
+def clear_team_match_queues(team_ids):
+    """Drops the cached queues of the members of ``team_ids``."""
+    user_ids = set(Profile.objects.filter(teams__in=team_ids).values_list('user', flat=True))
+    cache.delete_many([open_match_queue_cache_key(user_id) for user_id in user_ids])
+
+
+@receiver(post_save, sender=TeamMembership, dispatch_uid="profiles_membership_saved_clear_dashboards")
+@receiver(post_delete, sender=TeamMembership, dispatch_uid="profiles_membership_deleted_clear_dashboards")
+def clear_membership_dashboards(sender, instance, **kwargs):
+    clear_captain_dashboards([instance.team_id], instance.profile_id)
+
+
+@receiver(post_save, sender=Match, dispatch_uid="profiles_match_saved_clear_dashboards")
+@receiver(post_delete, sender=Match, dispatch_uid="profiles_match_deleted_clear_dashboards")
+def clear_match_dashboards(sender, instance, signal=None, **kwargs):
+    if delete_receiver_deferred(signal):
+        return
+    clear_captain_dashboards([instance.home_team_id, instance.away_team_id])
+
+
+@receiver(post_save, sender=Match, dispatch_uid="profiles_match_saved_clear_queues")
+@receiver(post_delete, sender=Match, dispatch_uid="profiles_match_deleted_clear_queues")
+def clear_match_queues(sender, instance, signal=None, **kwargs):
+    """A match is only queued for the members of its two teams until both
+    lineups are in; from then on every member of the tournament may report it."""
+    if delete_receiver_deferred(signal):
+        return
+    if signal is post_delete or instance.published or (instance.home_submitted and instance.away_submitted):
+        clear_open_match_queues([instance.tournament_id])
+    else:
+        clear_team_match_queues([instance.home_team_id, instance.away_team_id])
+
+
+@receiver(post_save, sender=TeamMembership, dispatch_uid="profiles_membership_saved_clear_queue")
+@receiver(post_delete, sender=TeamMembership, dispatch_uid="profiles_membership_deleted_clear_queue")
+def clear_membership_queue(sender, instance, **kwargs):
+    cache.delete_many([open_match_queue_cache_key(user_id)
+                       for user_id in Profile.objects.filter(pk=instance.profile_id).values_list('user', flat=True)])
+
+
+@receiver(post_save, sender=Team, dispatch_uid="profiles_team_saved_clear_ids")
+@receiver(post_delete, sender=Team, dispatch_uid="profiles_team_deleted_clear_ids")
+def clear_team_ids(sender, instance, **kwargs):
+    cache.delete(team_ids_cache_key(instance.tournament_id))
+
+
+def bump_team_versions(teams):
+    """teams is a list of (tournament_id, slug)"""
+    keys = set()
+    for tournament_id, slug in teams:
+        keys.add(team_version_key(tournament_id, slug))
+        keys.add(tournament_version_key(tournament_id))
+    if keys:
+        bump_versions(*keys)
+
+
+@receiver(post_save, sender=Team, dispatch_uid="profiles_team_saved_bump_version")
+@receiver(post_delete, sender=Team, dispatch_uid="profiles_team_deleted_bump_version")
+def bump_team_version(sender, instance, **kwargs):
+    bump_team_versions([(instance.tournament_id, instance.slug)])
+
+
+@receiver(post_save, sender=TeamMembership, dispatch_uid="profiles_membership_saved_bump_version")
+@receiver(post_delete, sender=TeamMembership, dispatch_uid="profiles_membership_deleted_bump_version")
+def bump_membership_version(sender, instance, **kwargs):
+    bump_team_versions(Team.objects.filter(pk=instance.team_id).values_list('tournament', 'slug'))
+
+
+@receiver(post_save, sender=Profile, dispatch_uid="profiles_profile_saved_bump_version")
+def bump_profile_version(sender, instance, created, **kwargs):
+    if not created:
+        bump_team_versions(Team.objects.filter(team_membership__profile=instance).values_list('tournament', 'slug'))
+
+
+@receiver(post_save, sender=Caster, dispatch_uid="profiles_caster_saved_clear_ids")
+@receiver(post_delete, sender=Caster, dispatch_uid="profiles_caster_deleted_clear_ids")
+def clear_caster_ids(sender, instance, **kwargs):
+    cache.delete(caster_ids_cache_key(instance.tournament_id))
+
+
 @receiver(socialauth_registered, sender=FacebookBackend, dispatch_uid="tournaments_facebook_extra_values")
 def facebook_extra_values(sender, user, response, details, **kwargs):
     for name, value in details.iteritems():
@@ -315,18 +601,6 @@ def facebook_extra_values(sender, user, response, details, **kwargs):
 
     profile = user.get_profile()
     profile.name = response.get('name')
-    if not profile.photo:
-        url = 'http://graph.facebook.com/%s/picture?type=large' % response.get('id')
-        try:
-            content = urllib2.urlopen(url)
-            # Facebook default image check
-            if sender.name == 'facebook' and 'image/gif' in str(content.info()):
-                return
-
-            filename = user.username + "_profile" + '.' + content.headers.subtype
-            profile.photo.save(filename, ContentFile(content.read()))
-        except IOError, e:
-            logger.debug(e)
     try:
         profile.language = response.get('locale').split("_")[0]
         profile.full_clean()
@@ -334,6 +608,8 @@ def facebook_extra_values(sender, user, response, details, **kwargs):
         pass
     profile.time_zone = response.get('timezone')
     profile.save()
+    if not profile.photo and response.get('id'):
+        send_task("profiles.tasks.import_facebook_photo", [profile.pk, response.get('id')])
     account = user.account_set.all()[0] or Account.create(user=user, create_email=False)
     try:
         account.language = response.get('locale').split("_")[0]
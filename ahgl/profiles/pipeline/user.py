@@ -14,6 +14,15 @@ from ..models import Profile
 logger = logging.getLogger(__name__)
 
 
+def username_candidates(username, short_username, uuid_length, username_fixer, count):
+    """Returns ``count`` usernames to try, the requested one first and then
+    the shortened one with a random hash appended."""
+    candidates = [username_fixer(username)[:USERNAME_MAX_LENGTH]]
+    while len(candidates) < count:
+        candidates.append(username_fixer(short_username + uuid4().get_hex()[:uuid_length])[:USERNAME_MAX_LENGTH])
+    return candidates
+
+
 def get_username(details, response, user=None, *args, **kwargs):
     """Return an username for new user. Return current user username
     if user was given.
@@ -31,24 +40,20 @@ def get_username(details, response, user=None, *args, **kwargs):
     uuid_lenght = getattr(settings, 'SOCIAL_AUTH_UUID_LENGTH', 16)
     username_fixer = getattr(settings, 'SOCIAL_AUTH_USERNAME_FIXER',
                              lambda u: u)
+    batch_size = getattr(settings, 'SOCIAL_AUTH_USERNAME_BATCH_SIZE', 8)
 
     short_username = username[:USERNAME_MAX_LENGTH - uuid_lenght]
-    final_username = None
 
+    # Check a whole batch of candidates with one query instead of one query
+    # per collision. Only the first batch contains the requested username,
+    # the rest use the original username cut to fit plus a unique hash.
     while True:
-        final_username = username_fixer(username)[:USERNAME_MAX_LENGTH]
-
-        try:
-            User.objects.get(username=final_username)
-        except User.DoesNotExist:
-            break
-        else:
-            # User with same username already exists, generate a unique
-            # username for current user using username as base but adding
-            # a unique hash at the end. Original username is cut to avoid
-            # the field max_length.
-            username = short_username + uuid4().get_hex()[:uuid_lenght]
-    return {'username': final_username}
+        candidates = username_candidates(username, short_username, uuid_lenght, username_fixer, batch_size)
+        taken = set(User.objects.filter(username__in=candidates).values_list('username', flat=True))
+        for final_username in candidates:
+            if final_username not in taken:
+                return {'username': final_username}
+        username = short_username + uuid4().get_hex()[:uuid_lenght]
 
 
 def create_user(backend, details, response, uid, username, user=None, *args,
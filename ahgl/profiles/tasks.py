@@ -0,0 +1,82 @@
+import logging
+import tempfile
+import urllib2
+
+from django.conf import settings
+from django.core.files import File
+from celery.task import task
+
+from utils.thumbnails import THUMBNAIL_SPECS, queue_thumbnails
+from .models import Profile, Team, bump_team_versions
+
+logger = logging.getLogger(__name__)
+
+FACEBOOK_PHOTO_URL = 'http://graph.facebook.com/{0}/picture?type=large'
+PHOTO_IMPORT_TIMEOUT = getattr(settings, 'PHOTO_IMPORT_TIMEOUT', 10)
+PHOTO_IMPORT_MAX_BYTES = getattr(settings, 'PHOTO_IMPORT_MAX_BYTES', 2 * 1024 * 1024)
+# Facebook serves its default silhouette as a gif, so gifs are not imported
+PHOTO_IMPORT_TYPES = {'image/jpeg': 'jpg', 'image/png': 'png'}
+CHUNK_SIZE = 64 * 1024
+
+
+class PhotoRejected(Exception):
+    pass
+
+
+def fetch_photo(url, timeout=PHOTO_IMPORT_TIMEOUT, max_bytes=PHOTO_IMPORT_MAX_BYTES):
+    """Streams the image at url into a temporary file and returns (file, extension).
+    Raises PhotoRejected if the response is not an accepted image or is larger
+    than max_bytes, and IOError for network errors and timeouts."""
+    response = urllib2.urlopen(url, timeout=timeout)
+    try:
+        content_type = response.info().gettype()
+        if content_type not in PHOTO_IMPORT_TYPES:
+            raise PhotoRejected("{0} is {1}".format(url, content_type))
+        length = response.info().getheader('Content-Length')
+        if length and length.isdigit() and int(length) > max_bytes:
+            raise PhotoRejected("{0} is {1} bytes".format(url, length))
+        photo = tempfile.TemporaryFile()
+        size = 0
+        for chunk in iter(lambda: response.read(CHUNK_SIZE), ''):
+            size += len(chunk)
+            if size > max_bytes:
+                photo.close()
+                raise PhotoRejected("{0} is over {1} bytes".format(url, max_bytes))
+            photo.write(chunk)
+        photo.seek(0)
+        return photo, PHOTO_IMPORT_TYPES[content_type]
+    finally:
+        response.close()
+
+
+@task(ignore_result=True, max_retries=5)
+def import_facebook_photo(profile_pk, facebook_id, url=None):
+    """Downloads the Facebook profile picture of a profile that has no photo yet"""
+    try:
+        profile = Profile.objects.select_related('user').get(pk=profile_pk)
+    except Profile.DoesNotExist as e:
+        # the login that queued us may not have committed yet
+        raise import_facebook_photo.retry(exc=e, countdown=10)
+    if profile.photo:
+        return
+    url = url or FACEBOOK_PHOTO_URL.format(facebook_id)
+    try:
+        photo, extension = fetch_photo(url)
+    except PhotoRejected as e:
+        logger.info(e)
+        return
+    except urllib2.HTTPError as e:
+        if e.code < 500:
+            logger.info(e)
+            return
+        raise import_facebook_photo.retry(exc=e, countdown=60 * 2 ** import_facebook_photo.request.retries)
+    except IOError as e:
+        raise import_facebook_photo.retry(exc=e, countdown=60 * 2 ** import_facebook_photo.request.retries)
+    with photo:
+        profile.photo.save(profile.user.username + "_profile." + extension, File(photo), save=False)
+    # only the photo column, so edits made to the profile meanwhile are kept
+    Profile.objects.filter(pk=profile_pk).update(photo=profile.photo.name)
+    if Profile in THUMBNAIL_SPECS:  # update() skips the post_save receiver that queues them
+        queue_thumbnails(Profile, profile)
+    # and bump_profile_version, so the team pages showing the photo are bumped here
+    bump_team_versions(Team.objects.filter(team_membership__profile=profile_pk).values_list('tournament', 'slug'))
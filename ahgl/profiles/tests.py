@@ -0,0 +1,278 @@
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from itertools import count
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.template import Context, Template
+from django.test import TestCase
+
+from tournaments.models import Tournament, Match, team_version_key
+from tournaments.tests import RecordQueries, build_tournament
+from .models import Caster, Profile, Team, TeamMembership, captain_dashboard, team_cache
+from .pipeline import user as user_pipeline
+from .tasks import PhotoRejected, fetch_photo, import_facebook_photo
+
+
+class FakeUUID(object):
+    """Hands out hashes from a small pool so generated usernames collide"""
+    def __init__(self, pool_size):
+        self.counter = count()
+        self.pool_size = pool_size
+
+    def __call__(self):
+        return self
+
+    def get_hex(self):
+        return "{0:032x}".format(next(self.counter) % self.pool_size)
+
+
+class GetUsernameTest(TestCase):
+    signups = 2000
+
+    def signup(self, name):
+        """Runs get_username for a signup and creates the user, returns the queries it took"""
+        with RecordQueries() as recorded:
+            username = user_pipeline.get_username({}, {'name': name})['username']
+        User.objects.create(username=username)
+        return len(recorded.queries)
+
+    def test_same_name_signups(self):
+        queries = [self.signup("Mike") for i in range(self.signups)]
+        self.assertEqual(User.objects.filter(username__startswith="mike").count(), self.signups)
+        self.assertEqual(max(queries), 1)
+
+    def test_colliding_hashes(self):
+        old_uuid4 = user_pipeline.uuid4
+        user_pipeline.uuid4 = FakeUUID(pool_size=self.signups * 4)
+        try:
+            queries = [self.signup("Mike") for i in range(self.signups)]
+        finally:
+            user_pipeline.uuid4 = old_uuid4
+        self.assertEqual(User.objects.filter(username__startswith="mike").count(), self.signups)
+        # every signup after the first collides on the name, and the second pass over the pool on hashes
+        self.assertTrue(float(sum(queries)) / self.signups < 2, "{0} queries per signup".format(float(sum(queries)) / self.signups))
+
+
+class AllocateSlugsTest(TestCase):
+    def setUp(self):
+        self.users = [User.objects.create(username="user{0}".format(i)) for i in range(4)]
+
+    def test_duplicates_within_a_batch(self):
+        profiles = [Profile(user=user, name=name) for user, name in zip(self.users, ("Mike", "mike", "MIKE"))]
+        with self.assertNumQueries(1):
+            Profile.allocate_slugs(profiles)
+        self.assertEqual([profile.slug for profile in profiles], ["mike", "mike_1", "mike_2"])
+
+    def test_existing_slugs(self):
+        for user, name in zip(self.users, ("Mike", "Mike", "Mikey")):
+            Profile.objects.create(user=user, name=name)
+        profiles = Profile.allocate_slugs([Profile(user=self.users[3], name="Mike"), Profile(user=self.users[3], name="Mikey")])
+        self.assertEqual([profile.slug for profile in profiles], ["mike_2", "mikey_1"])
+
+    def test_unsluggable_names(self):
+        self.users[1].username = u"\ubc15"
+        self.users[1].save()
+        profiles = [Profile(user=user, name=u"\uc774\uc7ac\ub3d9") for user in self.users[:3]]
+        with self.assertNumQueries(1):
+            Profile.allocate_slugs(profiles)
+        self.assertEqual([profile.slug for profile in profiles], ["user0", "player", "user2"])
+
+    def test_save_retries_a_taken_slug(self):
+        allocate_slugs = Profile.__dict__['allocate_slugs']
+        allocated = []
+
+        def racing(cls, profiles):
+            profiles = allocate_slugs.__get__(None, cls)(profiles)
+            if not allocated:
+                # another signup inserts the same slug before this one does
+                Profile.objects.bulk_create([Profile(user=self.users[1], name="Mike", slug=profiles[0].slug)])
+            allocated.append(profiles[0].slug)
+            return profiles
+        Profile.allocate_slugs = classmethod(racing)
+        try:
+            profile = Profile.objects.create(user=self.users[0], name="Mike")
+        finally:
+            Profile.allocate_slugs = allocate_slugs
+        self.assertEqual(allocated, ["mike", "mike_1"])
+        self.assertEqual(Profile.objects.get(pk=profile.pk).slug, "mike_1")
+
+
+class TeamRosterTest(TestCase):
+    members = 8
+
+    def setUp(self):
+        build_tournament(teams=3, members=self.members, rounds=1, games=5)
+        self.team = Team.objects.get(slug="team-1-0")
+        # the records only count published matches
+        Match.objects.filter(home_team=self.team, away_team__slug="team-1-2").update(published=False)
+
+    def test_fixed_queries(self):
+        with self.assertNumQueries(3):
+            members = self.team.load_roster()
+            records = dict((member.char_name, (member.profile.name, member.win_count, member.loss_count)) for member in members)
+            captains = [captain.char_name for captain in self.team.captains]
+            self.assertTrue(self.team.has_minimum_members)
+        self.assertEqual(len(records), self.members)
+        self.assertEqual(captains, [self.team.team_membership.get(captain=True).char_name])
+        for member in TeamMembership.objects.filter(team=self.team):
+            self.assertEqual(records[member.char_name], (member.profile.name, member.wins, member.losses))
+
+
+class CaptainDashboardTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        build_tournament(teams=2, members=3, rounds=1, games=2)
+        Match.objects.update(published=False)
+        self.team = Team.objects.get(slug="team-1-0")
+        self.membership = self.team.team_membership.get(captain=True)
+        self.captain = self.membership.profile.user
+
+    def test_non_captain_gets_nothing(self):
+        player = self.team.team_membership.filter(captain=False)[0].profile.user
+        self.assertEqual(captain_dashboard(player), {'teams': [], 'memberships': [], 'matches': []})
+
+    def test_match_change_clears(self):
+        dashboard = captain_dashboard(self.captain)
+        self.assertEqual([team.pk for team in dashboard['teams']], [self.team.pk])
+        self.assertEqual(len(dashboard['memberships']), 3)
+        self.assertEqual([match.lineup_submitted for match in dashboard['matches']], [True])
+        with self.assertNumQueries(0):
+            captain_dashboard(self.captain)
+        match = Match.objects.get(home_team=self.team)
+        match.home_submitted = False
+        match.save(notify=False)
+        self.assertEqual([match.lineup_submitted for match in captain_dashboard(self.captain)['matches']], [False])
+
+    def test_membership_change_clears(self):
+        captain_dashboard(self.captain)
+        player = self.team.team_membership.filter(captain=False)[0]
+        player.char_name = "Renamed"
+        player.save()
+        self.assertTrue("Renamed" in [membership.char_name for membership in captain_dashboard(self.captain)['memberships']])
+        self.membership.captain = False
+        self.membership.save()
+        self.assertEqual(captain_dashboard(self.captain)['teams'], [])
+
+
+class TeamCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.tournament = Tournament.objects.create(slug="season-1", name="Season 1")
+        self.team = Team.objects.create(tournament=self.tournament, name="Home", slug="home")
+
+    def test_save_and_delete_evict(self):
+        team_cache.get(tournament=self.tournament, slug="home")
+        with self.assertNumQueries(0):
+            self.assertEqual(team_cache.get(tournament=self.tournament, slug="home"), self.team)
+            self.assertEqual(team_cache.get_by_pk(self.team.pk).name, "Home")
+        self.team.name = "Renamed"
+        self.team.save()
+        self.assertEqual(team_cache.get_by_pk(self.team.pk).name, "Renamed")
+        self.assertEqual(team_cache.get(tournament=self.tournament, slug="home").name, "Renamed")
+        pk = self.team.pk
+        self.team.delete()
+        self.assertRaises(Team.DoesNotExist, team_cache.get_by_pk, pk)
+        self.assertRaises(Team.DoesNotExist, team_cache.get, tournament=self.tournament, slug="home")
+
+
+class HTMLFieldTest(TestCase):
+    unsafe = u'<strong>Casting</strong> since 2010<script>alert("owned")</script>'
+
+    def setUp(self):
+        self.tournament = Tournament.objects.create(slug="season-1", name="Season 1")
+        self.user = User.objects.create(username="caster")
+
+    def render(self, caster):
+        return Template("{{ caster.description }}").render(Context({'caster': caster}))
+
+    def assertCleaned(self, pk):
+        caster = Caster.objects.get(pk=pk)
+        self.assertNotIn(u"<script>", caster.description)
+        # cleaned on the way in, so rendered raw on the way out
+        self.assertIn(u"<strong>Casting</strong>", self.render(caster))
+
+    def test_unsaved_value_is_escaped(self):
+        caster = Caster(user=self.user, tournament=self.tournament, description=self.unsafe)
+        self.assertIn(u"&lt;script&gt;", self.render(caster))
+        caster.save()
+        self.assertNotIn(u"<script>", self.render(caster))
+        loaded = Caster.objects.get(pk=caster.pk)
+        loaded.description = self.unsafe
+        self.assertIn(u"&lt;script&gt;", self.render(loaded))
+
+    def test_save_cleans(self):
+        caster = Caster.objects.create(user=self.user, tournament=self.tournament, description=self.unsafe)
+        self.assertCleaned(caster.pk)
+        caster = Caster.objects.get(pk=caster.pk)
+        caster.description = self.unsafe
+        caster.save()
+        self.assertCleaned(caster.pk)
+
+    def test_bulk_create_cleans(self):
+        Caster.objects.bulk_create([Caster(user=self.user, tournament=self.tournament, description=self.unsafe)])
+        self.assertCleaned(Caster.objects.get(user=self.user).pk)
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serves whatever the test queued in server.response, a (content type, body, delay) tuple"""
+    def do_GET(self):
+        content_type, body, delay = self.server.response
+        time.sleep(delay)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ImportFacebookPhotoTest(TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.url = "http://127.0.0.1:{0}/picture".format(self.server.server_port)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        user = User.objects.create(username="facebooker")
+        self.profile = Profile.objects.create(user=user, name="Face Booker")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_stores_photo(self):
+        self.server.response = ('image/jpeg', 'jpeg bytes', 0)
+        import_facebook_photo(self.profile.pk, "1", url=self.url)
+        profile = Profile.objects.get(pk=self.profile.pk)
+        try:
+            self.assertTrue(profile.photo.name.endswith("facebooker_profile.jpg"))
+            self.assertEqual(profile.photo.read(), 'jpeg bytes')
+        finally:
+            profile.photo.delete(save=False)
+
+    def test_bumps_team_versions(self):
+        tournament = Tournament.objects.create(slug="season-1", name="Season 1")
+        team = Team.objects.create(tournament=tournament, name="Home", slug="home")
+        TeamMembership.objects.create(team=team, profile=self.profile, char_name="Booker")
+        cache.clear()
+        self.server.response = ('image/png', 'png bytes', 0)
+        import_facebook_photo(self.profile.pk, "1", url=self.url)
+        Profile.objects.get(pk=self.profile.pk).photo.delete(save=False)
+        self.assertTrue(cache.get(team_version_key(tournament.pk, "home")))
+
+    def test_skips_default_gif(self):
+        self.server.response = ('image/gif', 'gif bytes', 0)
+        import_facebook_photo(self.profile.pk, "1", url=self.url)
+        self.assertFalse(Profile.objects.get(pk=self.profile.pk).photo)
+
+    def test_rejects_oversized(self):
+        self.server.response = ('image/png', 'x' * 2048, 0)
+        self.assertRaises(PhotoRejected, fetch_photo, self.url, max_bytes=1024)
+
+    def test_times_out(self):
+        self.server.response = ('image/png', 'png bytes', 1)
+        self.assertRaises(IOError, fetch_photo, self.url, timeout=0.1)
@@ -25,8 +25,12 @@ from idios.utils import get_profile_model
 from account.models import EmailAddress
 
 from utils.views import ObjectPermissionsCheckMixin
-from .models import Team, TeamMembership, Profile, Caster
-from tournaments.models import TournamentRound, Tournament
+from utils.sampling import shuffled
+from utils.versions import versioned
+from .models import (Team, TeamMembership, Profile, Caster,
+                     caster_ids_cache_key, captain_dashboard, team_cache, charity_cache)
+from tournaments.models import (TournamentRound, Tournament, tournament_cache,
+                                tournament_version_key, team_version_key)
 
 
 class TournamentSlugContextView(object):
@@ -42,12 +46,22 @@ class TournamentSlugContextView(object):
 
 class TeamDetailView(TournamentSlugContextView, DetailView):
     def get_context_data(self, **kwargs):
+        self.object.load_roster()
         context = super(TeamDetailView, self).get_context_data(**kwargs)
         context['is_captain'] = self.request.user.is_authenticated() and any((captain.profile.user_id == self.request.user.id for captain in self.object.captains))
         return context
 
-    def get_queryset(self):
-        return Team.objects.filter(tournament=self.kwargs['tournament']).select_related('charity')
+    def get_object(self, queryset=None):
+        try:
+            team = team_cache.get(tournament=self.kwargs['tournament'], slug=self.kwargs['slug'])
+        except Team.DoesNotExist:
+            raise Http404(_(u"No %(verbose_name)s found matching the query") %
+                          {'verbose_name': Team._meta.verbose_name})
+        return charity_cache.attach([team], 'charity')[0]
+
+    @method_decorator(versioned(lambda request, tournament, slug: [team_version_key(tournament, slug)]))
+    def dispatch(self, *args, **kwargs):
+        return super(TeamDetailView, self).dispatch(*args, **kwargs)
 
 
 class TeamUpdateView(ObjectPermissionsCheckMixin, TournamentSlugContextView, UpdateView):
@@ -150,15 +164,7 @@ class TeamAdminView(ListView):
         return TeamMembership.objects.filter(profile__user=self.request.user, captain=True)
 
     def get_context_data(self, **kwargs):
-        # Probably a better way to do this with joins, but I never remember how
-        # to do that with Django. Sorry.
-        team_ids = set(m.team_id for m in self.get_queryset()) # Why isn't this already in self.queryset?
-        teams = Team.objects.filter(id__in=team_ids)
-        memberships = TeamMembership.objects.filter(team_id__in=team_ids)
-        return {
-            'teams': teams,
-            'memberships': memberships,
-        }
+        return captain_dashboard(self.request.user)
 
     def get_template_names(self):
         return "profiles/team_admin.html"
@@ -172,7 +178,10 @@ class TeamListView(TournamentSlugContextView, ListView):
 class StandingsView(TournamentSlugContextView, ListView):
     def get_context_data(self, **kwargs):
         ctx = super(StandingsView, self).get_context_data(**kwargs)
-        ctx["show_points"] = get_object_or_404(Tournament.objects.only('structure'), pk=self.kwargs['tournament']).structure == "I"
+        try:
+            ctx["show_points"] = tournament_cache.get(pk=self.kwargs['tournament']).structure == "I"
+        except Tournament.DoesNotExist:
+            raise Http404
         return ctx
 
     def get_queryset(self):
@@ -181,6 +190,10 @@ class StandingsView(TournamentSlugContextView, ListView):
     def get_template_names(self):
         return "profiles/standings.html"
 
+    @method_decorator(versioned(lambda request, tournament: [tournament_version_key(tournament)]))
+    def dispatch(self, *args, **kwargs):
+        return super(StandingsView, self).dispatch(*args, **kwargs)
+
 
 class TeamMembershipCreateView(CreateView):
     model = TeamMembership
@@ -311,7 +324,7 @@ class MVPView(TournamentSlugContextView, ListView):
     context_object_name = "players"
 
     def get_queryset(self):
-        return TeamMembership.objects.filter(team__tournament=self.kwargs.get('tournament'), game_wins__match__published=True).select_related('team', 'profile').annotate(win_count=Count('game_wins')).order_by('-win_count')
+        return TeamMembership.objects.card().filter(team__tournament=self.kwargs.get('tournament'), game_wins__match__published=True).annotate(win_count=Count('game_wins')).order_by('-win_count')
 
 
 class MyProfileDetailView(ProfileDetailView):
@@ -333,4 +346,5 @@ class CasterListView(ListView):
     context_object_name = "casters"
 
     def get_queryset(self):
-        return Caster.objects.filter(tournament=self.kwargs.get('tournament')).order_by('-active', '?')
+        tournament = self.kwargs.get('tournament')
+        return shuffled(Caster.objects.filter(tournament=tournament), caster_ids_cache_key(tournament), 'active')
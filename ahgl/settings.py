@@ -72,6 +72,10 @@ STATIC_ROOT = os.path.join(PROJECT_ROOT, "site_media", "static")
 # Example: "http://media.lawrence.com"
 STATIC_URL = "/site_media/static/"
 
+# Absolute path to the directory that holds pages of completed tournaments
+# rendered by the freeze_tournament command.
+FROZEN_PAGES_ROOT = os.path.join(PROJECT_ROOT, "site_media", "frozen")
+
 # Additional directories which hold static files
 STATICFILES_DIRS = [
     os.path.join(PROJECT_ROOT, "static"),
@@ -108,6 +112,7 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = [
+    "utils.middleware.FrozenPageMiddleware",
     "johnny.middleware.QueryCacheMiddleware",
     "django.middleware.cache.UpdateCacheMiddleware",
     "django.middleware.gzip.GZipMiddleware",
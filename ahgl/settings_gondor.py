@@ -80,6 +80,7 @@ SITE_ID = 1  # set this to match your Sites setup
 
 MEDIA_ROOT = os.path.join(os.environ["GONDOR_DATA_DIR"], "site_media", "media")
 STATIC_ROOT = os.path.join(os.environ["GONDOR_DATA_DIR"], "site_media", "static")
+FROZEN_PAGES_ROOT = os.path.join(os.environ["GONDOR_DATA_DIR"], "site_media", "frozen")
 
 MEDIA_URL = "/site_media/media/"  # make sure this maps inside of a static_urls URL
 STATIC_URL = "/site_media/static/"  # make sure this maps inside of a static_urls URL
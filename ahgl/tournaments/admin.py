@@ -1,15 +1,18 @@
 from django.contrib import admin
 from django.conf.urls.defaults import patterns, url
-from django.db import transaction
+from django.db import router, transaction
 from django.db.models.fields.related import RelatedField
 from django.contrib.admin.actions import delete_selected
+from django.contrib.admin.util import get_deleted_objects
+from django.core.exceptions import PermissionDenied
+from django.utils.encoding import force_unicode
 from django.utils import timezone
 
 from .views import NewTournamentRoundView
 from .models import Tournament, TournamentRound, Map, Match, Game
-from profiles.models import Team, TeamMembership
+from profiles.models import Team, TeamMembership, clear_open_match_queues
 
-from .tasks import update_round_stats
+from .tasks import update_round_stats, delete_matches
 import settings
 
 
@@ -79,8 +82,8 @@ class GameInline(admin.TabularInline):
             if hasattr(request, "membership_queryset"):
                 kwargs["queryset"] = request.membership_queryset
             else:
-                request.membership_queryset = kwargs["queryset"] = TeamMembership.objects.filter(team__in=[self.parent.home_team, self.parent.away_team]).only('char_name')
-        cache_field("team", Team.objects.filter(tournament=self.parent.tournament_id) if self.parent else Team.objects.all(), db_field, request, kwargs)
+                request.membership_queryset = kwargs["queryset"] = TeamMembership.objects.choice().filter(team__in=[self.parent.home_team_id, self.parent.away_team_id])
+        cache_field("team", Team.objects.choice().filter(tournament=self.parent.tournament_id) if self.parent else Team.objects.choice(), db_field, request, kwargs)
         cache_field("map", self.parent.tournament.map_pool.all() if self.parent else Map.objects.all(), db_field, request, kwargs)
         return super(GameInline, self).formfield_for_foreignkey(db_field, request, **kwargs)
 
@@ -119,7 +122,7 @@ class MatchAdmin(admin.ModelAdmin):
         return super(MatchAdmin, self).get_form(request, obj=obj, **kwargs)
 
     def formfield_for_foreignkey(self, db_field, request, **kwargs):
-        cache_field("team", Team.objects.filter(tournament=self.obj.tournament_id), db_field, request, kwargs)
+        cache_field("team", Team.objects.choice().filter(tournament=self.obj.tournament_id), db_field, request, kwargs)
         cache_field("tournament_round", TournamentRound.objects.filter(tournament=self.obj.tournament_id).only('order', 'stage_name'), db_field, request, kwargs)
         return super(MatchAdmin, self).formfield_for_foreignkey(db_field, request, **kwargs)
 
@@ -133,6 +136,8 @@ class MatchAdmin(admin.ModelAdmin):
         for match in queryset.all():
             match.update_winloss()
             match.update_tiebreaker()
+        # update() skips the match save receivers
+        clear_open_match_queues(set(queryset.values_list('tournament', flat=True)))
         if rows_updated == 1:
             message_bit = "1 match was"
         else:
@@ -141,16 +146,29 @@ class MatchAdmin(admin.ModelAdmin):
     publish_match.short_description = "Publish matches so they are visible to all users"
 
     def delete_and_update_stats(self, request, queryset):
-        ret = delete_selected(self, request, queryset)
-        if request.POST.get('post'):
-            teamset = set()
-            for match in queryset:
-                for team in (match.home_team, match.away_team):
-                    if team:
-                        teamset.add(team)
-            for team in teamset:
-                team.update_stats()
-        return ret
+        if not request.POST.get('post'):
+            # delete_selected's confirmation page, posting back to this action
+            response = delete_selected(self, request, queryset)
+            if response is not None:
+                response.template_name = "admin/tournaments/match/delete_and_update_stats_confirmation.html"
+            return response
+        if not self.has_delete_permission(request):
+            raise PermissionDenied
+        # as delete_selected does, refuse if the cascade reaches objects the user may not delete
+        deletable_objects, perms_needed, protected = get_deleted_objects(
+            queryset, self.model._meta, request.user, self.admin_site, router.db_for_write(self.model))
+        if perms_needed or protected:
+            raise PermissionDenied
+        match_pks = []
+        for match in queryset:
+            self.log_deletion(request, match, force_unicode(match))
+            match_pks.append(match.pk)
+        if len(match_pks) > getattr(settings, "MATCH_DELETE_ASYNC_THRESHOLD", 50):
+            delete_matches.delay(match_pks)
+            self.message_user(request, "%s matches are being deleted, team stats will be updated when done." % len(match_pks))
+        else:
+            delete_matches(match_pks)
+            self.message_user(request, "Successfully deleted %s matches and updated team stats." % len(match_pks))
     delete_and_update_stats.short_description = "Deletes matches and updates all team stats associated with those matches"
 
 admin.site.register(Tournament, TournamentAdmin)
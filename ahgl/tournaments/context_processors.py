@@ -1,6 +1,6 @@
 import re
 
-from .models import Tournament
+from .models import Tournament, tournament_cache
 
 re_tourney_matcher = re.compile(r'^/(?P<tournament>[\w_-]+)/')
 
@@ -8,7 +8,7 @@ re_tourney_matcher = re.compile(r'^/(?P<tournament>[\w_-]+)/')
 def tournament(request):
     context = {'tournament_slug': re_tourney_matcher.search(request.path).group('tournament')}
     try:
-        context['tournament'] = Tournament.objects.get(slug=context['tournament_slug'])
+        context['tournament'] = tournament_cache.get(pk=context['tournament_slug'])
     except Tournament.DoesNotExist:
         pass
     return context
@@ -1,4 +1,6 @@
-from django.forms.models import BaseModelFormSet
+from django import forms
+from django.core.validators import EMPTY_VALUES
+from django.forms.models import BaseModelFormSet, BaseInlineFormSet
 
 from .models import Match
 
@@ -12,6 +14,12 @@ class BaseMatchFormSet(BaseModelFormSet):
         return Match.objects.none()
 
 
+class GameReportFormSet(BaseInlineFormSet):
+    def get_queryset(self):
+        # the report template shows each game's map and players
+        return super(GameReportFormSet, self).get_queryset().select_related('map', 'home_player', 'away_player')
+
+
 class MultipleFormSetBase(object):
     def __init__(self, prefix=None, *args, **kwargs):
         if prefix is None:
@@ -46,3 +54,25 @@ class MultipleFormSetBase(object):
     def save(self, commit=True):
         return tuple(form.save(commit) for form in self.forms if hasattr(form, "save"))
     save.alters_data = True
+
+
+class LoadedModelChoiceField(forms.ModelChoiceField):
+    """A ModelChoiceField over a list of already loaded objects, so the forms of
+    a formset can share one load instead of each querying for its choices and
+    again to validate the submitted value."""
+    def __init__(self, model, objects, *args, **kwargs):
+        objects = list(objects)
+        self.objects_by_pk = dict((obj.pk, obj) for obj in objects)
+        super(LoadedModelChoiceField, self).__init__(model._default_manager.none(), *args, **kwargs)
+        choices = [(obj.pk, self.label_from_instance(obj)) for obj in objects]
+        if self.empty_label is not None:
+            choices.insert(0, (u"", self.empty_label))
+        self.choices = choices
+
+    def to_python(self, value):
+        if value in EMPTY_VALUES:
+            return None
+        try:
+            return self.objects_by_pk[int(value)]
+        except (KeyError, ValueError, TypeError):
+            raise forms.ValidationError(self.error_messages['invalid_choice'])
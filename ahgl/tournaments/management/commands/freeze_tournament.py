@@ -0,0 +1,108 @@
+# coding=utf8
+from __future__ import print_function
+
+import os
+import shutil
+from multiprocessing import Pool
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test.client import Client
+
+from tournaments.models import Match, Tournament
+from profiles.models import Team, TeamMembership
+from utils.middleware import frozen_file
+
+
+def tournament_paths(tournament):
+    """Every public page of a tournament"""
+    slug = tournament.slug
+    for name in ('standings', 'schedule', 'matches', 'teams', 'games', 'videos', 'mvp'):
+        yield reverse(name, kwargs={'tournament': slug})
+    for pk in Match.objects.filter(tournament=tournament, published=True).values_list('pk', flat=True):
+        yield reverse('match_page', kwargs={'tournament': slug, 'pk': pk})
+    for team in Team.objects.filter(tournament=tournament).values_list('slug', flat=True):
+        yield reverse('team_page', kwargs={'tournament': slug, 'slug': team})
+        yield reverse('matches', kwargs={'tournament': slug, 'team': team})
+    for team, profile in TeamMembership.objects.filter(team__tournament=tournament).values_list('team__slug', 'profile__slug'):
+        kwargs = {'tournament': slug, 'team': team, 'profile': profile}
+        yield reverse('player_profile', kwargs=kwargs)
+        yield reverse('games', kwargs=kwargs)
+
+
+def init_worker():
+    # forked workers must not share the parent's database connection
+    connection.close()
+
+
+def render_page(args):
+    """Renders one page through the full stack and writes it under root. Returns (path, error)"""
+    path, root = args
+    try:
+        response = Client().get(path, HTTP_X_FROZEN_BYPASS="1")
+    except Exception as e:
+        return path, repr(e)
+    if response.status_code != 200:
+        return path, "status {0}".format(response.status_code)
+    filename = frozen_file(root, path)
+    try:
+        os.makedirs(os.path.dirname(filename))
+    except OSError:
+        if not os.path.isdir(os.path.dirname(filename)):
+            raise
+    with open(filename, 'wb') as f:
+        f.write(response.content)
+    return path, None
+
+
+class Command(BaseCommand):
+    args = '[tournament_slug ...]'
+    help = 'Renders all public pages of completed tournaments to static files served by FrozenPageMiddleware'
+    option_list = BaseCommand.option_list + (
+        make_option('--workers',
+                    type='int',
+                    dest='workers',
+                    default=4,
+                    help='Number of worker processes rendering pages'),
+        make_option('--output',
+                    dest='output',
+                    default=getattr(settings, 'FROZEN_PAGES_ROOT', None),
+                    help='Directory to write the pages to (defaults to FROZEN_PAGES_ROOT)'),
+    )
+
+    def handle(self, *args, **options):
+        root = options['output']
+        if not root:
+            raise CommandError("No output directory given and FROZEN_PAGES_ROOT is not set")
+        tournaments = Tournament.objects.filter(status='C')
+        if args:
+            tournaments = tournaments.filter(slug__in=args)
+            missing = set(args).difference(tournaments.values_list('slug', flat=True))
+            if missing:
+                raise CommandError("Tournaments {0} do not exist or are not completed".format(", ".join(missing)))
+
+        staging = os.path.join(root, ".staging")
+        for tournament in tournaments:
+            paths = list(tournament_paths(tournament))
+            print("Freezing {0} pages of {1}".format(len(paths), tournament), file=self.stdout)
+            shutil.rmtree(os.path.join(staging, tournament.slug), ignore_errors=True)
+
+            connection.close()
+            pool = Pool(processes=options['workers'], initializer=init_worker)
+            try:
+                failed = [(path, error) for path, error in pool.imap_unordered(render_page, ((path, staging) for path in paths)) if error]
+            finally:
+                pool.close()
+                pool.join()
+            for path, error in failed:
+                print("Could not render {0}: {1}".format(path, error), file=self.stderr)
+
+            # swap the whole tournament in at once so a half written tree is never served
+            staged, target = os.path.join(staging, tournament.slug), os.path.join(root, tournament.slug)
+            if os.path.isdir(staged):
+                shutil.rmtree(target, ignore_errors=True)
+                os.rename(staged, target)
+        shutil.rmtree(staging, ignore_errors=True)
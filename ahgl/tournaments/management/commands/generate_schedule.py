@@ -0,0 +1,63 @@
+# coding=utf8
+from __future__ import print_function
+
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from tournaments.models import TournamentRound
+from profiles.models import clear_captain_dashboards, clear_open_match_queues
+
+
+class Command(BaseCommand):
+    args = '<tournament_slug> <round_order> <start_date YYYY-MM-DD>'
+    help = 'Creates a round robin of weekly matches between the teams of a tournament round'
+    option_list = BaseCommand.option_list + (
+        make_option('--double',
+                    action='store_true',
+                    dest='double',
+                    default=False,
+                    help='Play every pairing twice, with the sides switched'),
+        make_option('--interval',
+                    type='int',
+                    dest='interval',
+                    default=7,
+                    help='Days between two weeks of matches'),
+        make_option('--stage',
+                    type='int',
+                    dest='stage',
+                    default=1,
+                    help='Stage order of the round'),
+        make_option('--no-notify',
+                    action='store_false',
+                    dest='notify',
+                    default=True,
+                    help='Do not notify the teams of their new matches'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 3:
+            raise CommandError("Usage: generate_schedule {0}".format(self.args))
+        slug, order, start = args
+        try:
+            tournament_round = TournamentRound.objects.select_related('tournament').get(tournament__slug=slug, order=order,
+                                                                                        stage_order=options['stage'])
+        except TournamentRound.DoesNotExist:
+            raise CommandError("Round {0} of stage {1} of {2} does not exist".format(order, options['stage'], slug))
+        try:
+            start_date = datetime.strptime(start, "%Y-%m-%d").date()
+        except ValueError:
+            raise CommandError("{0} is not a YYYY-MM-DD date".format(start))
+
+        try:
+            matches = tournament_round.create_schedule(start_date, double=options['double'],
+                                                       interval=timedelta(days=options['interval']), notify=options['notify'])
+        except ValidationError as e:
+            raise CommandError(u" ".join(e.messages))
+        # the bulk insert skips the match save receivers
+        clear_captain_dashboards(set(team_id for match in matches for team_id in (match.home_team_id, match.away_team_id)))
+        clear_open_match_queues([tournament_round.tournament_id])
+        weeks = len(set(match.creation_date for match in matches))
+        print("Created {0} matches over {1} weeks".format(len(matches), weeks), file=self.stdout)
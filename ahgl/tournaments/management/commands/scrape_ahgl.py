@@ -1,13 +1,16 @@
 # coding=utf8
 from __future__ import print_function
 
+import os
 import re
-import urllib2
 import posixpath
+import tempfile
 import lxml.html as html
 from lxml.html import tostring
 import traceback
 import datetime
+from collections import defaultdict
+from contextlib import contextmanager
 from optparse import make_option
 
 from django.contrib.auth.models import User
@@ -16,11 +19,177 @@ from django.core.exceptions import ValidationError
 from django.core.management.base import BaseCommand, CommandError
 from django.template.defaultfilters import slugify
 from django.conf import settings
-from django.db.models import Q
+from django.db.models.signals import post_save
 
 from tournaments.models import (Game, Map, Match, TeamRoundMembership,
-                                Tournament, TournamentRound, replay_path)
-from profiles.models import Charity, Profile, Team, TeamMembership
+                                Tournament, TournamentRound, replay_path,
+                                update_winloss, update_tiebreaker)
+from tournaments.tasks import repair_stats
+from profiles.models import (Charity, Profile, Team, TeamMembership, team_cache, bump_team_versions,
+                             clear_captain_dashboards, clear_open_match_queues)
+from utils.fetch import Fetcher, FetchError
+
+
+class IdentityMap(object):
+    """The teams, rounds, matches, games and memberships of a tournament and
+    all maps, loaded once so the scraper resolves names without a query per
+    game. Rows the scraper creates are added as they are saved, and changed
+    memberships are written once per page by ``flush``."""
+    def __init__(self, tournament, master_user):
+        self.tournament = tournament
+        self.master_user = master_user
+        self.teams_by_slug, self.teams_by_name = {}, {}
+        for team in Team.objects.filter(tournament=tournament):
+            self.add_team(team)
+        self.rounds = defaultdict(list)  # team id -> rounds
+        for membership in TeamRoundMembership.objects.filter(tournamentround__tournament=tournament).select_related('tournamentround'):
+            self.add_round_team(membership.tournamentround, membership.team_id)
+        self.matches, matches_by_pk = {}, {}
+        for match in Match.objects.filter(tournament=tournament):
+            self.add_match(match)
+            matches_by_pk[match.pk] = match
+        self.games = {}
+        for game in Game.objects.filter(match__tournament=tournament):
+            game._match_cache = matches_by_pk[game.match_id]  # so game saves update the mapped match
+            self.games[game.match_id, game.order] = game
+        self.members = defaultdict(list)  # lowercased char name -> memberships
+        for membership in TeamMembership.objects.filter(team__tournament=tournament):
+            self.add_membership(membership)
+        self.maps = dict((map.name, map) for map in Map.objects.all())
+        self.dirty = {}
+
+    def add_team(self, team):
+        self.teams_by_slug[team.slug] = self.teams_by_name[team.name] = team
+
+    def team_by_slug(self, slug):
+        try:
+            return self.teams_by_slug[slug]
+        except KeyError:
+            raise Team.DoesNotExist(slug)
+
+    def team_by_name(self, name):
+        try:
+            return self.teams_by_name[name]
+        except KeyError:
+            raise Team.DoesNotExist(name)
+
+    def add_round_team(self, tournament_round, team_id):
+        if tournament_round not in self.rounds[team_id]:
+            self.rounds[team_id].append(tournament_round)
+
+    def rounds_of(self, home_team, away_team):
+        """The rounds both teams are in, by stage"""
+        return sorted((tournament_round for tournament_round in self.rounds[home_team.pk] if tournament_round in self.rounds[away_team.pk]),
+                      key=lambda tournament_round: tournament_round.stage_order)
+
+    def add_match(self, match):
+        self.matches[match.home_team_id, match.away_team_id, match.creation_date] = match
+
+    def match(self, home_team, away_team, creation_date):
+        return self.matches.get((home_team.pk, away_team.pk, creation_date))
+
+    def game(self, match, order, map):
+        """Returns (game, created) like get_or_create, except a new game is not
+        saved yet; it is mapped already, since the scraper always saves it."""
+        game = self.games.get((match.pk, order))
+        if game is not None:
+            return game, False
+        game = self.games[match.pk, order] = Game(match=match, order=order, map=map)
+        return game, True
+
+    def saved_game(self, match, order):
+        game = self.games.get((match.pk, order))
+        return game if game is not None and game.pk else None
+
+    def map(self, name):
+        """Returns (map, created) like get_or_create"""
+        if name in self.maps:
+            return self.maps[name], False
+        self.maps[name] = map = Map.objects.create(name=name)
+        return map, True
+
+    def add_membership(self, membership):
+        self.members[membership.char_name.lower()].append(membership)
+
+    def replace_membership(self, membership, old_char_name=None):
+        """Maps the saved ``membership`` in place of the mapped row with its pk,
+        which is under ``old_char_name`` when the membership was renamed"""
+        for name in set(((old_char_name or membership.char_name).lower(), membership.char_name.lower())):
+            if name in self.members:
+                self.members[name] = [mapped for mapped in self.members[name] if mapped.pk != membership.pk]
+        self.add_membership(membership)
+
+    def member(self, team, char_name):
+        if not char_name:
+            return None
+        for membership in self.members.get(char_name.lower(), ()):
+            if membership.team_id == team.pk:
+                return membership
+        return None
+
+    def player(self, char_name, char_code, teams):
+        """The membership of the tournament named char_name, picking by
+        char_code and then by ``teams`` (preferred first) when the name is
+        shared. A membership found by name only gets the char_code."""
+        candidates = self.members.get(char_name.lower(), [])
+        if char_code is not None:
+            candidates = [membership for membership in candidates if membership.char_code == char_code] or candidates
+        if len(candidates) > 1:
+            for team in teams:
+                on_team = [membership for membership in candidates if membership.team_id == team.pk]
+                if on_team:
+                    candidates = on_team
+                    break
+        if not candidates:
+            return None
+        membership = candidates[0]
+        if char_code is not None and membership.char_code != char_code:
+            membership.char_code = char_code
+            self.changed(membership)
+        return membership
+
+    def changed(self, membership):
+        self.dirty[membership.pk] = membership
+
+    def create_members(self, wanted):
+        """Creates the (team, char name) memberships that are missing, with a
+        profile named after the char name since the admin site has no names,
+        in one bulk insert each"""
+        missing, seen = [], set()
+        for team, char_name in wanted:
+            if (team.pk, char_name.lower()) in seen or self.member(team, char_name):
+                continue
+            seen.add((team.pk, char_name.lower()))
+            missing.append((team, char_name))
+        if not missing:
+            return
+        profiles = Profile.allocate_slugs(Profile(name=char_name, user=self.master_user) for team, char_name in missing)
+        Profile.objects.bulk_create(profiles)
+        # bulk_create does not set primary keys, and the slugs are unique
+        profile_ids = dict(Profile.objects.filter(slug__in=[profile.slug for profile in profiles]).values_list('slug', 'pk'))
+        TeamMembership.objects.bulk_create([TeamMembership(team=team, profile_id=profile_ids[profile.slug], char_name=char_name)
+                                            for (team, char_name), profile in zip(missing, profiles)])
+        for membership in TeamMembership.objects.filter(profile__in=profile_ids.values()):
+            self.add_membership(membership)
+
+    def flush(self):
+        """Writes the memberships changed since the last flush, once each"""
+        for membership in self.dirty.values():
+            TeamMembership.objects.filter(pk=membership.pk).update(char_code=membership.char_code, race=membership.race)
+        self.dirty.clear()
+
+
+@contextmanager
+def stats_deferred():
+    """Match saves recompute the stats of both teams through post_save
+    receivers; the import recomputes them all once at the end instead."""
+    post_save.disconnect(sender=Match, dispatch_uid="tournaments_update_winloss")
+    post_save.disconnect(sender=Match, dispatch_uid="tournaments_update_tiebreaker")
+    try:
+        yield
+    finally:
+        post_save.connect(update_winloss, sender=Match, dispatch_uid="tournaments_update_winloss")
+        post_save.connect(update_tiebreaker, sender=Match, dispatch_uid="tournaments_update_tiebreaker")
 
 
 class Command(BaseCommand):
@@ -47,6 +216,25 @@ class Command(BaseCommand):
                     dest='admin',
                     default=False,
                     help='Scrape data from admin page'),
+        make_option('--workers',
+                    type='int',
+                    dest='workers',
+                    default=8,
+                    help='Number of concurrent downloads'),
+        make_option('--cache-dir',
+                    dest='cache_dir',
+                    default=os.path.join(tempfile.gettempdir(), "scrape_ahgl"),
+                    help='Directory the downloaded pages and files are kept in, so reruns only fetch what is new'),
+        make_option('--offline',
+                    action='store_true',
+                    dest='offline',
+                    default=False,
+                    help='Only replay responses from the cache directory'),
+        make_option('--refresh',
+                    action='store_true',
+                    dest='refresh',
+                    default=False,
+                    help='Download the team, player, match and result pages again instead of reading the cache (the files they link to are kept)'),
     )
 
     first_week_match = datetime.date(2012, 1, 6)
@@ -68,13 +256,26 @@ class Command(BaseCommand):
             return self._map_map[mapname]
         return mapname
 
-    def visit_url(self, path, base=None):
+    def parse_url(self, url, fresh=False):
+        """``fresh`` for the index pages, which change as the season goes on;
+        the other pages only with --refresh"""
+        d = html.document_fromstring(self.fetcher.get(url, fresh=fresh or self.options['refresh']), base_url=url)
+        d.make_links_absolute()
+        return d
+
+    def visit_url(self, path, base=None, fresh=False):
         url = posixpath.join(base, path) if base else path
         print("Visiting {0}".format(url), file=self.stdout)
-        self.d = d = html.parse(url).getroot()
-        d.make_links_absolute()
+        self.d = d = self.parse_url(url, fresh)
         return d
 
+    def player_photo_url(self, member_url):
+        """The photo on a player page, to prefetch it along with the page"""
+        try:
+            return self.parse_url(member_url).cssselect('.content-section-1 p img')[0].get('src')
+        except (IOError, IndexError):
+            return None
+
     def load_player(self, member_url, team, char_name=None):
         """ Loads player and team membership data, and adds as member to team. Return profile, membership """
         try:
@@ -87,6 +288,7 @@ class Command(BaseCommand):
             profile.save()
             membership = TeamMembership(team=team, profile=profile, char_name=char_name, active=False)
             membership.save()
+            self.entities.add_membership(membership)
             return profile, membership
 
         if "Player not found in database" in tostring(member_d):
@@ -99,15 +301,18 @@ class Command(BaseCommand):
             char_name = info_ps[4].text
             if "." in char_name:
                 char_name = char_name.split(".", 1)[0]
-        if Profile.objects.filter(name=profile_name).count():
-            profile, created = Profile.objects.get(name=profile_name), False
+        profiles = list(Profile.objects.filter(name=profile_name)[:1])
+        old_char_name = None
+        if profiles:
+            profile, created = profiles[0], False
             membership, membership_created = TeamMembership.objects.get_or_create(team=team, profile=profile, defaults={'char_name': char_name})
+            old_char_name = membership.char_name
             membership.char_name = char_name
         else:
-            try:
-                membership = TeamMembership.objects.get(team=team, char_name=char_name)
+            membership = self.entities.member(team, char_name)
+            if membership is not None:
                 profile, created = membership.profile, False
-            except TeamMembership.DoesNotExist:
+            else:
                 # create profile and membership
                 profile, created = Profile(name=profile_name, user=self.master_user), True
                 profile.save()
@@ -117,7 +322,7 @@ class Command(BaseCommand):
         member_photo_url = info_ps[0].cssselect('img')[0].get('src')
         if member_photo_url != self.unknown_photo:
             filename = slugify(profile.name) + posixpath.splitext(member_photo_url)[1]
-            profile.photo.save(filename, ContentFile(urllib2.urlopen(member_photo_url).read()))
+            profile.photo.save(filename, ContentFile(self.fetcher.get(member_photo_url)))
         if info_ps[3].text:
             profile.title = info_ps[3].text
         if info_ps[-1].text:  # deal with blank race
@@ -140,6 +345,7 @@ class Command(BaseCommand):
         else:
             profile.save()
             membership.save()
+            self.entities.replace_membership(membership, old_char_name)
         return profile, membership
 
     def load_team(self, team_url, team_name):
@@ -147,10 +353,17 @@ class Command(BaseCommand):
 
         # load team data
         team, created = Team.objects.get_or_create(tournament=self.tournament, name=team_name, slug=slugify(team_name), defaults={'rank': 1})
+        self.entities.add_team(team)
         print(created, file=self.stdout)
         photo_url = team_d.cssselect('.content-section-1 img')[0].get('src')
+        member_as = [member_li.cssselect("a")[0] for member_li in team_d.cssselect("ul.player-list-1.cf li")]
+        member_urls = [member_a.get("href") for member_a in member_as]
+        self.fetcher.prefetch(member_urls, fresh=self.options['refresh'])
+        self.fetcher.prefetch([photo_url] + [img.get('src') for img in team_d.cssselect('.content-section-4 img')[:1]]
+                              + [member_a.cssselect('img')[0].get('src') for member_a in member_as])
+        self.fetcher.prefetch(self.player_photo_url(member_url) for member_url in member_urls)
         filename = slugify(team_name) + posixpath.splitext(photo_url)[1]
-        team.photo.save(filename, ContentFile(urllib2.urlopen(photo_url).read()))
+        team.photo.save(filename, ContentFile(self.fetcher.get(photo_url)))
 
         charity_p = team_d.cssselect('.content-section-3 p')[0 if self.tournament.slug == "starcraft-2-season-1" else 1]
         charity_name = charity_p.cssselect('a')[0].text
@@ -163,7 +376,7 @@ class Command(BaseCommand):
             try:
                 charity_photo_url = team_d.cssselect('.content-section-4 img')[0].get('src')
                 filename = slugify(charity_name) + posixpath.splitext(charity_photo_url)[1]
-                charity.logo.save(filename, ContentFile(urllib2.urlopen(charity_photo_url).read()))
+                charity.logo.save(filename, ContentFile(self.fetcher.get(charity_photo_url)))
             except IndexError:
                 print("{team} did not have expected image section for charity, leaving blank".format(team=team_name), file=self.stderr)
         charity.full_clean()
@@ -181,58 +394,71 @@ class Command(BaseCommand):
                 member_thumbnail_url = member_a.cssselect('img')[0].get('src')
                 if member_thumbnail_url != self.unknown_photo:
                     filename = slugify(profile.name) + posixpath.splitext(member_thumbnail_url)[1]
-                    profile.custom_thumb.save(filename, ContentFile(urllib2.urlopen(member_thumbnail_url).read()))
+                    profile.custom_thumb.save(filename, ContentFile(self.fetcher.get(member_thumbnail_url)))
 
         team.full_clean()
         team.save()
         return team
 
     def find_round(self, home_team, away_team, creation_date):
-        for round in TournamentRound.objects.filter(teams__pk=home_team.pk).filter(teams__pk=away_team.pk).order_by('stage_order'):
-            previous_matchup_count = round.matches.filter(creation_date__lt=creation_date) \
-                                                  .filter((Q(home_team=home_team) & Q(away_team=away_team)) | (Q(home_team=away_team) & Q(away_team=home_team))) \
-                                                  .count()
-            if not previous_matchup_count:
+        pairing = set((home_team.pk, away_team.pk))
+        for round in self.entities.rounds_of(home_team, away_team):
+            previous_matchup = any(match.tournament_round_id == round.pk and match.creation_date < creation_date
+                                   and set((match.home_team_id, match.away_team_id)) == pairing
+                                   for match in self.entities.matches.itervalues())
+            if not previous_matchup:
                 break
         return round
 
+    def get_or_create_match(self, home_team, away_team, creation_date):
+        match = self.entities.match(home_team, away_team, creation_date)
+        if match is not None:
+            return match, False
+        round = self.find_round(home_team, away_team, creation_date)
+        match = Match(home_team=home_team, away_team=away_team, creation_date=creation_date, tournament=self.tournament, tournament_round=round)
+        match.save(notify=False)
+        self.entities.add_match(match)
+        return match, True
+
     def load_match(self, match_url, week=None):
         match_d = self.visit_url(match_url)
 
         if not match_d.cssselect('a.first-title'):
             print("Not a real match....skipping", file=self.stderr)
             return
-        home_team = Team.objects.get(slug=slugify(match_d.cssselect('a.first-title')[0].text.strip()), tournament=self.tournament)
-        away_team = Team.objects.get(slug=slugify(match_d.cssselect('a.second-title')[0].text.strip()), tournament=self.tournament)
+        home_team = self.entities.team_by_slug(slugify(match_d.cssselect('a.first-title')[0].text.strip()))
+        away_team = self.entities.team_by_slug(slugify(match_d.cssselect('a.second-title')[0].text.strip()))
         if week is None:
             week = int(re.search('week[^/]*([\d]+)[^/]*/', match_url).group(1)) - 1
         print("{0} week".format(week), file=self.stdout)
         creation_date = self.first_week_match + self.a_week * week
-        round = self.find_round(home_team, away_team, creation_date)
-        match, match_created = Match.objects.get_or_create(home_team=home_team, away_team=away_team, creation_date=creation_date, tournament=self.tournament, defaults={'tournament_round': round})
+        match, match_created = self.get_or_create_match(home_team, away_team, creation_date)
         match.published = True
         match.publish_date = match.creation_date + self.a_week + datetime.timedelta(days=5)
         match.home_submitted = True
         match.away_submitted = True
 
         match.save(notify=False)
+        game_lis = match_d.cssselect('li.cf')
+        self.fetcher.prefetch([img.get('src') for game_li in game_lis for img in game_li.cssselect('a.video-link > img')[:1]]
+                              + [a.get('href') for game_li in game_lis for a in game_li.cssselect('.video-link-container > p > a')[:1]])
         # add games
         for order, game_li in enumerate(match_d.cssselect('li.cf'), start=1):
             map = " ".join(game_li.cssselect('.video-link-container h3')[0].text.split()[3:])
             map = self.coerse_mapname(map.strip())
             # Map creation
-            map, created = Map.objects.get_or_create(name=map)
+            map, created = self.entities.map(map)
             if created or not map.photo:
                 print("Created map {name}".format(name=map.name.encode('ascii', 'ignore')), file=self.stdout)
                 map_photo_url = game_li.cssselect('a.video-link > img')[0].get('src')
                 filename = slugify(map.name) + posixpath.splitext(map_photo_url)[1]
-                map.photo.save(filename, ContentFile(urllib2.urlopen(map_photo_url).read()))
+                map.photo.save(filename, ContentFile(self.fetcher.get(map_photo_url)))
                 map.full_clean()
                 map.save()
             self.tournament.map_pool.add(map)
 
             # Game creation
-            game, game_created = Game.objects.get_or_create(match=match, order=order, defaults={"map": map})
+            game, game_created = self.entities.game(match, order, map)
             game.map = map  # just assure the current coersed version
             #if game_created:
             #    print("Created game {order}".format(order=order), file=self.stdout)
@@ -245,9 +471,10 @@ class Command(BaseCommand):
                 away_player_url = game_li.cssselect('.video-player-link-container.last a')[0].get('href')
                 members = ("home", "away")
                 for team, char_name, url, member in zip((match.home_team, match.away_team), (home_player, away_player), (home_player_url, away_player_url), members):
-                    try:
-                        setattr(game, "_".join((member, "player")), TeamMembership.objects.get(team=team, char_name__iexact=char_name))
-                    except TeamMembership.DoesNotExist:
+                    membership = self.entities.member(team, char_name)
+                    if membership is not None:
+                        setattr(game, "_".join((member, "player")), membership)
+                    else:
                         if char_name == "???" or "#" in url:
                             if char_name != "???":
                                 print("Player {0} not found...ignoring".format(char_name), file=self.stderr)
@@ -271,23 +498,18 @@ class Command(BaseCommand):
         replay_url = replay_a[0].get('href')
         replay_name = replay_path(game, posixpath.basename(replay_url))
         try:
-            game.replay.save(replay_name, ContentFile(urllib2.urlopen(replay_url).read()))
-        except urllib2.HTTPError:
+            game.replay.save(replay_name, ContentFile(self.fetcher.get(replay_url)))
+        except FetchError:
             print("Replay not found {replay_url}...ignoring".format(replay_url=replay_url), file=self.stderr)
 
-    def create_membership(self, team, char_name, active=True):
-        #print(team,char_name)
-        try:
-            return TeamMembership.objects.get(team=team, char_name__iexact=char_name), False
-        except TeamMembership.DoesNotExist:
-            if active:
-                profile, created = Profile(name=char_name, user=self.master_user), True  # have to use fake name since admin doesn't have names
-                profile.save()
-                membership = TeamMembership(team=team, profile=profile, char_name=char_name)
-                print("Creating player {0}".format(membership.char_name), file=self.stdout)
-                membership.save()
-                return membership, created
-        return None, False
+    def create_memberships(self, wanted):
+        """Creates the missing (team, char name) players in bulk"""
+        seen = set()
+        for team, char_name in wanted:
+            if (team.pk, char_name.lower()) not in seen and self.entities.member(team, char_name) is None:
+                print("Creating player {0}".format(char_name), file=self.stdout)
+            seen.add((team.pk, char_name.lower()))
+        self.entities.create_members(wanted)
 
     re_lineup = re.compile(r"((?P<home_name>[^\.\s]+)(\. ?(?P<home_code>[^\s]+))? +(\([^\)]+\) )?\((?P<home_race>[\w])\))? \< (?P<map>[^\>]+) \> (\((?P<away_race>[\w])\) (?P<away_name>[^\.]+)(\.(?P<away_code>[^\s]+))?)?")
     re_captain = re.compile(r"(?P<name>[^,]+), (?P<email>[^@]+@[^\.]+\.[^,]+), (?P<char_name>[^\.]+)\.(?P<char_code>[\d]+)")
@@ -297,18 +519,25 @@ class Command(BaseCommand):
         week = int(lineup_d.cssselect("h1")[0].text.strip().rsplit(None, 1)[-1]) - 1
         matches_needing_games = []
         map_pool = []
+        matchups = []
         for match_h2, matchup_p in zip(lineup_d.cssselect("h2"), lineup_d.cssselect("p")):
             home_team, away_team = (s.strip() for s in match_h2.text.split(":")[1].split(" vs "))
-            home_team = Team.objects.get(name=home_team, tournament=self.tournament)
-            away_team = Team.objects.get(name=away_team, tournament=self.tournament)
+            matchups.append((self.entities.team_by_name(home_team), self.entities.team_by_name(away_team), matchup_p))
+        # the players new to the site are created for the whole page at once
+        wanted = []
+        for home_team, away_team, matchup_p in matchups:
+            for game_text in matchup_p.itertext():
+                game_matcher = self.re_lineup.search(game_text.strip())
+                if game_matcher and game_matcher.group("away_race"):
+                    wanted += [(home_team, game_matcher.group("home_name")), (away_team, game_matcher.group("away_name"))]
+        self.create_memberships(wanted)
 
+        for home_team, away_team, matchup_p in matchups:
             creation_date = self.first_week_match + self.a_week * week
-            try:  # ug, inconsistencies in ordering....
-                match = Match.objects.get(home_team=away_team, away_team=home_team, creation_date=creation_date, tournament=self.tournament)
-            except Match.DoesNotExist:
+            match = self.entities.match(away_team, home_team, creation_date)  # ug, inconsistencies in ordering....
+            if match is None:
                 reverse_order = False
-                round = self.find_round(home_team, away_team, creation_date)
-                match, match_created = Match.objects.get_or_create(home_team=home_team, away_team=away_team, creation_date=creation_date, tournament=self.tournament, defaults={'tournament_round': round})
+                match, match_created = self.get_or_create_match(home_team, away_team, creation_date)
                 if match_created:
                     print("Creating new match {0} vs {1}".format(home_team, away_team), file=self.stdout)
                 else:
@@ -330,19 +559,19 @@ class Command(BaseCommand):
                         matches_needing_games.append(match)
                     continue
                 map_name = self.coerse_mapname(game_matcher.group('map').strip())
-                map, map_created = Map.objects.get_or_create(name=map_name)
+                map, map_created = self.entities.map(map_name)
                 if map_created:
                     print("{0} map not found...creating".format(map_name), file=self.stderr)
                     self.tournament.map_pool.add(map)
 
-                game, game_created = Game.objects.get_or_create(match=match, order=order, defaults={"map": map})
+                game, game_created = self.entities.game(match, order, map)
                 game.map = map  # just assure the current coersed version
                 if game_created:
                     print("  Creating new game {0} {1} {2}".format(home_team.name, map_name, away_team.name), file=self.stdout)
                     match.games.add(game)
                 if game_matcher.group("away_race"):  # not ace match, load up player data
-                    p1, p1_created = self.create_membership(team=home_team, char_name=game_matcher.group("home_name"))
-                    p2, p2_created = self.create_membership(team=away_team, char_name=game_matcher.group("away_name"))
+                    p1 = self.entities.member(home_team, game_matcher.group("home_name"))
+                    p2 = self.entities.member(away_team, game_matcher.group("away_name"))
                     p1race = game_matcher.group("home_race").upper()
                     p2race = game_matcher.group("away_race").upper()
                     if reverse_order:
@@ -366,8 +595,8 @@ class Command(BaseCommand):
                     except (ValueError, TypeError):
                         pass
                     p2.race = p2.race or p2race
-                    p1.save()
-                    p2.save()
+                    self.entities.changed(p1)
+                    self.entities.changed(p2)
                     maps.append((map, False))
                 else:
                     game.is_ace = True
@@ -381,7 +610,7 @@ class Command(BaseCommand):
                 for match in matches_needing_games:
                     print("Match {0} had no map information...using information from other matches".format(match), file=self.stdout)
                     for order, (map, is_ace) in enumerate(map_pool, start=1):
-                        game, game_created = Game.objects.get_or_create(match=match, order=order, defaults={"map": map})
+                        game, game_created = self.entities.game(match, order, map)
                         if game_created:
                             print("Created game on map {0}".format(map.name), file=self.stdout)
                         game.is_ace = is_ace
@@ -392,24 +621,25 @@ class Command(BaseCommand):
                 print("No map information was gathered for this week, so deleting all matches.", file=self.stdout)
                 for match in matches_needing_games:
                     match.delete()
+                    self.entities.matches.pop((match.home_team_id, match.away_team_id, match.creation_date), None)
+        self.entities.flush()
 
     re_result = re.compile("\): (?P<home_name>[^\.:\s]+)(\. ?(?P<home_code>[^\s]+))? +(\([^\)]+\) )?\((?P<home_race>[\w])\) (?P<win_ptr>&lt;|&gt;) \((?P<away_race>[\w])\) (?P<away_name>[^\.]+)(\.(?P<away_code>[^\s]+))? +--")
 
     def load_result(self, result_url):
         result_d = self.visit_url(result_url)
         week = int(result_d.cssselect("h1")[0].text.strip().rsplit(None, 1)[-1]) - 1
+        self.fetcher.prefetch(a.get('href') for a in result_d.cssselect("p a"))
         for match_h2, matchup_p in zip(result_d.cssselect("h2"), result_d.cssselect("p")[1:]):
             home_team, away_team = (s.strip() for s in match_h2.text.split(":")[1].split(" vs "))
-            home_team = Team.objects.get(name=home_team, tournament=self.tournament)
-            away_team = Team.objects.get(name=away_team, tournament=self.tournament)
+            home_team = self.entities.team_by_name(home_team)
+            away_team = self.entities.team_by_name(away_team)
             creation_date = self.first_week_match + self.a_week * week
-            try:  # ug, inconsistencies in ordering....
-                match = Match.objects.get(home_team=away_team, away_team=home_team, creation_date=creation_date, tournament=self.tournament)
-            except Match.DoesNotExist:
+            match = self.entities.match(away_team, home_team, creation_date)  # ug, inconsistencies in ordering....
+            if match is None:
                 reverse_order = False
-                try:
-                    match = Match.objects.get(home_team=home_team, away_team=away_team, creation_date=creation_date, tournament=self.tournament)
-                except Match.DoesNotExist:  # this means we didn't have any map data, so we had deleted the matches
+                match = self.entities.match(home_team, away_team, creation_date)
+                if match is None:  # this means we didn't have any map data, so we had deleted the matches
                     continue
                 print("Processing match {0} vs {1}".format(home_team, away_team), file=self.stdout)
             else:
@@ -420,64 +650,26 @@ class Command(BaseCommand):
             p_string = tostring(matchup_p)[3:-4]
             for order, game_text in enumerate(p_string.split("<br>")[:-1], start=1):
                 if "Not played" not in game_text:
-                    try:
-                        game = Game.objects.get(match=match, order=order)
-                    except Game.DoesNotExist:
+                    game = self.entities.saved_game(match, order)
+                    if game is None:
                         print("{0} game does not exist...skipping".format(order), file=self.stderr)
                         continue
                     game_matcher = self.re_result.search(game_text.strip())
                     if not game_matcher:
                         print("Could not match on {0} ...skipping".format(game_text.strip()), file=self.stderr)
                         continue
-                    try:
-                        try:
-                            home_code = int(game_matcher.group("home_code").strip())
-                        except (ValueError, AttributeError):
-                            home_code = None
-                            home_player = TeamMembership.objects.get(char_name__iexact=game_matcher.group("home_name").strip())
-                        else:
-                            try:
-                                home_player = TeamMembership.objects.get(char_name__iexact=game_matcher.group("home_name").strip(), char_code=home_code)
-                            except TeamMembership.DoesNotExist:
-                                print(game_matcher.group("home_name").strip())
-                                home_player = TeamMembership.objects.get(char_name__iexact=game_matcher.group("home_name").strip())
-                                home_player.char_code = home_code
-                                home_player.save()
-                    except TeamMembership.MultipleObjectsReturned:
-                        kwargs = dict(team=home_team, char_name__iexact=game_matcher.group("home_name").strip())
-                        if home_code:
-                            kwargs['char_code'] = home_code
-                        #print(kwargs)
-                        try:
-                            home_player = TeamMembership.objects.get(**kwargs)
-                        except TeamMembership.DoesNotExist:
-                            kwargs['team'] = away_team
-                            away_player = TeamMembership.objects.get(**kwargs)
-                    try:
+                    players = []
+                    for side, teams in (("home", (home_team, away_team)), ("away", (away_team, home_team))):
+                        char_name = game_matcher.group("_".join((side, "name"))).strip()
                         try:
-                            away_code = int(game_matcher.group("away_code").strip())
+                            char_code = int(game_matcher.group("_".join((side, "code"))).strip())
                         except (ValueError, AttributeError):
-                            away_code = None
-                            try:
-                                away_player = TeamMembership.objects.get(char_name__iexact=game_matcher.group("away_name").strip().encode('ascii', 'ignore'))
-                            except TeamMembership.DoesNotExist:
-                                print(">" + game_matcher.group("away_name").strip().encode('ascii', 'ignore') + "<", "did not match")
-                        else:
-                            try:
-                                away_player = TeamMembership.objects.get(char_name__iexact=game_matcher.group("away_name").strip(), char_code=away_code)
-                            except TeamMembership.DoesNotExist:
-                                away_player = TeamMembership.objects.get(char_name__iexact=game_matcher.group("away_name").strip())
-                                away_player.char_code = away_code
-                                away_player.save()
-                    except TeamMembership.MultipleObjectsReturned:
-                        kwargs = dict(team=away_team, char_name__iexact=game_matcher.group("away_name").strip())
-                        if away_code:
-                            kwargs['char_code'] = away_code
-                        try:
-                            away_player = TeamMembership.objects.get(**kwargs)
-                        except TeamMembership.DoesNotExist:
-                            kwargs['team'] = home_team
-                            home_player = TeamMembership.objects.get(**kwargs)
+                            char_code = None
+                        player = self.entities.player(char_name, char_code, teams)
+                        if player is None:
+                            print(">" + char_name.encode('ascii', 'ignore') + "<", "did not match", file=self.stderr)
+                        players.append(player)
+                    home_player, away_player = players
 
                     home_race = game_matcher.group("home_race").upper()
                     away_race = game_matcher.group("away_race").upper()
@@ -509,7 +701,8 @@ class Command(BaseCommand):
                         game.forfeit = True
                     game.full_clean()
                     game.save()
-            match.remove_extra_victories()
+            match.remove_extra_victories(update_stats=False)
+        self.entities.flush()
 
     def handle(self, *args, **options):
         self.options = options
@@ -523,71 +716,91 @@ class Command(BaseCommand):
             self.first_week_match = datetime.date(2011, 6, 24)
 
         settings.INSTALLED_APPS.remove("notification")
+        self.fetcher = Fetcher(options['cache_dir'], workers=options['workers'], offline=options['offline'])
+        self.entities = IdentityMap(self.tournament, self.master_user)
 
         try:
-            if options['team']:
-                # Load teams
-                teams_d = self.visit_url("teams", self.site_url)
-                for team_li in teams_d.cssselect('.result-list li'):
-                    team_a = team_li.cssselect('a')[0]
-                    team_url = team_a.get('href')
-                    team_name = " ".join(team_a.text_content().strip().split()[:-1])
-                    self.load_team(team_url, team_name)
-
-            if options['match']:
-                # load groups
-                schedule_d = self.visit_url("schedule", self.site_url)
-                if options['whole_team']:
-                    round_lis = schedule_d.cssselect(".season-list-item")[0].cssselect(".week-list-1 .week-list-1")
-                else:
-                    round_lis = schedule_d.cssselect('#week-1-schedule li.season-list-item')
-                for i, group_li in enumerate(round_lis, start=1):
-                    round, created = TournamentRound.objects.get_or_create(order=i, stage_order=1, tournament=self.tournament, default={'stage_name': "Group"})
-                    print("Round {0} retrieved, adding members".format(i), file=self.stdout)
-                    for team_span in group_li.cssselect('.week-list-link > span.f2'):
-                        team_slug = slugify(team_span.text.strip())
-                        tried_nospace = False
-                        while True:
-                            try:
-                                team = Team.objects.get(slug=team_slug, tournament=self.tournament)
-                                round.teams.add(team)
-                                print("Team {slug} successfully added".format(slug=team_slug), file=self.stdout)
-                                break
-                            except Team.DoesNotExist:
-                                if not tried_nospace:
-                                    print("Team {slug} not found...trying without spaces".format(slug=team_slug), file=self.stdout)
-                                    team_slug = team_slug.replace('-', '')
-                                    tried_nospace = True
-                                else:
-                                    print("Team {slug} not found................skipping".format(slug=team_slug), file=self.stdout)
+            with stats_deferred():
+                if options['team']:
+                    # Load teams
+                    teams_d = self.visit_url("teams", self.site_url, fresh=True)
+                    self.fetcher.prefetch((team_li.cssselect('a')[0].get('href') for team_li in teams_d.cssselect('.result-list li')),
+                                          fresh=options['refresh'])
+                    for team_li in teams_d.cssselect('.result-list li'):
+                        team_a = team_li.cssselect('a')[0]
+                        team_url = team_a.get('href')
+                        team_name = " ".join(team_a.text_content().strip().split()[:-1])
+                        self.load_team(team_url, team_name)
+
+                if options['match']:
+                    # load groups
+                    schedule_d = self.visit_url("schedule", self.site_url, fresh=True)
+                    if options['whole_team']:
+                        round_lis = schedule_d.cssselect(".season-list-item")[0].cssselect(".week-list-1 .week-list-1")
+                    else:
+                        round_lis = schedule_d.cssselect('#week-1-schedule li.season-list-item')
+                    for i, group_li in enumerate(round_lis, start=1):
+                        round, created = TournamentRound.objects.get_or_create(order=i, stage_order=1, tournament=self.tournament, defaults={'stage_name': "Group"})
+                        print("Round {0} retrieved, adding members".format(i), file=self.stdout)
+                        for team_span in group_li.cssselect('.week-list-link > span.f2'):
+                            team_slug = slugify(team_span.text.strip())
+                            tried_nospace = False
+                            while True:
+                                try:
+                                    team = self.entities.team_by_slug(team_slug)
+                                    round.teams.add(team)
+                                    self.entities.add_round_team(round, team.pk)
+                                    print("Team {slug} successfully added".format(slug=team_slug), file=self.stdout)
                                     break
-
-                # load matches
-                for week, week_li in enumerate(schedule_d.cssselect("li.season-list-item")):
-                    for match_li in week_li.cssselect('li.week-list-item'):
-                        match_url = list(match_li.cssselect('a.week-list-link'))[-1].get('href')
-                        self.load_match(match_url, week)
-
-            # ----------- Admin site ------------------
-            if options['admin']:
-
-                # load lineups (extra match info)
-                lineup_d = self.visit_url("show-lineup", admin_url)
-                for a in lineup_d.cssselect("a"):
-                    self.load_lineup(a.get('href'))
-
-                # load results
-                result_d = self.visit_url("show-result", admin_url)
-                for a in result_d.cssselect("a"):
-                    self.load_result(a.get('href'))
-
-            # ----------- Update stats ------------------
-            for team in Team.objects.filter(tournament=self.tournament):
-                team.update_stats()
-            for membership in TeamRoundMembership.objects.filter(tournamentround__tournament=self.tournament):
-                membership.update_stats()
-
+                                except Team.DoesNotExist:
+                                    if not tried_nospace:
+                                        print("Team {slug} not found...trying without spaces".format(slug=team_slug), file=self.stdout)
+                                        team_slug = team_slug.replace('-', '')
+                                        tried_nospace = True
+                                    else:
+                                        print("Team {slug} not found................skipping".format(slug=team_slug), file=self.stdout)
+                                        break
+
+                    # load matches
+                    self.fetcher.prefetch((list(match_li.cssselect('a.week-list-link'))[-1].get('href')
+                                           for match_li in schedule_d.cssselect("li.season-list-item li.week-list-item")),
+                                          fresh=options['refresh'])
+                    for week, week_li in enumerate(schedule_d.cssselect("li.season-list-item")):
+                        for match_li in week_li.cssselect('li.week-list-item'):
+                            match_url = list(match_li.cssselect('a.week-list-link'))[-1].get('href')
+                            self.load_match(match_url, week)
+
+                # ----------- Admin site ------------------
+                if options['admin']:
+
+                    # load lineups (extra match info)
+                    lineup_d = self.visit_url("show-lineup", admin_url, fresh=True)
+                    self.fetcher.prefetch((a.get('href') for a in lineup_d.cssselect("a")), fresh=options['refresh'])
+                    for a in lineup_d.cssselect("a"):
+                        self.load_lineup(a.get('href'))
+
+                    # load results
+                    result_d = self.visit_url("show-result", admin_url, fresh=True)
+                    self.fetcher.prefetch((a.get('href') for a in result_d.cssselect("a")), fresh=options['refresh'])
+                    for a in result_d.cssselect("a"):
+                        self.load_result(a.get('href'))
         except Exception as e:
             print('Error occurred, dumping last document\n {0}'.format(tostring(self.d) if hasattr(self, "d") else None), file=self.stderr)
             traceback.print_exc(file=self.stderr)
             print(e, file=self.stderr)
+        finally:
+            # even after an error, since whatever was saved before it needs its stats and caches updated
+            self.update_stats()
+
+    def update_stats(self):
+        """Recomputes the stats of every team once for the whole import, the
+        match saves left them alone"""
+        teams = self.entities.teams_by_slug.values()
+        pairs = set(TeamRoundMembership.objects.filter(tournamentround__tournament=self.tournament).values_list('tournamentround', 'team'))
+        pairs.update((None, team.pk) for team in teams)
+        repair_stats(pairs)
+        # the bulk inserts and updates skipped the cache invalidating receivers
+        team_cache.invalidate_pks([team.pk for team in teams])
+        bump_team_versions([(team.tournament_id, team.slug) for team in teams])
+        clear_captain_dashboards([team.pk for team in teams])
+        clear_open_match_queues([self.tournament.pk])
@@ -1,15 +1,18 @@
-from collections import namedtuple
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+from datetime import timedelta
 import posixpath
 import logging
 import math
 from itertools import count, takewhile, groupby
 import os.path
+import threading
 
-from django.db import models
+from django.db import models, transaction
 from django.db.models import Count
 from django.utils.translation import ugettext_lazy as _
 from django.dispatch import receiver
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.template.defaultfilters import date, slugify
@@ -27,11 +30,51 @@ else:
     notification = None
 
 from profiles import RACES
+from utils.modelcache import ModelCache
+from utils.sampling import random_sample
+from utils.thumbnails import pregenerate
+from utils.versions import version_key, bump_versions
 
 
 logger = logging.getLogger(__name__)
 
 
+def team_ids_cache_key(tournament_id):
+    return ":".join(("tournament_team_ids", unicode(tournament_id)))
+
+
+def tournament_version_key(tournament_id):
+    return version_key("tournament", tournament_id)
+
+
+def match_version_key(match_id):
+    return version_key("match", match_id)
+
+
+def team_version_key(tournament_id, team_slug):
+    return version_key("team", tournament_id, team_slug)
+
+
+_bulk_delete = threading.local()
+
+
+@contextmanager
+def delete_receivers_deferred():
+    """Deleting a match or game clears caches and bumps versions through
+    post_delete receivers; a bulk delete does it once at the end instead. The
+    receivers stay connected and only skip the deletes of the current thread
+    (or green thread, once eventlet has patched threading)."""
+    deferred, _bulk_delete.active = getattr(_bulk_delete, 'active', False), True
+    try:
+        yield
+    finally:
+        _bulk_delete.active = deferred
+
+
+def delete_receiver_deferred(signal):
+    return signal is post_delete and getattr(_bulk_delete, 'active', False)
+
+
 def validate_wholenumber(value):
     if value < 1:
         raise ValidationError(u'{0} is not a whole number'.format(value))
@@ -46,7 +89,7 @@ class Tournament(models.Model):
     structure = models.CharField(max_length=1, choices=(('I', 'Individual'), ('T', 'Team'),), default='I')
 
     def random_teams(self, amount=7):
-        return self.teams.order_by('?')[:amount]
+        return random_sample(self.teams.all(), team_ids_cache_key(self.pk), amount)
 
     def stages(self):
         return self.rounds.values('stage_name', 'stage_order').distinct().order_by('stage_order')
@@ -73,6 +116,11 @@ class Map(models.Model):
         ordering = ('name',)
 
 
+tournament_cache = ModelCache(Tournament)
+map_cache = ModelCache(Map)
+pregenerate(Map, photo=(("595x170", {}), ("470x160", {})))
+
+
 BracketRow = namedtuple("BracketRow", "items, name")
 TeamBracketRecord = namedtuple("TeamBracketRecord", "home_team_membership, away_team_membership, match, is_champion")
 
@@ -142,6 +190,62 @@ class TournamentRound(models.Model):
                 yield BracketRow([TeamBracketRecord(None, None, None, False)] * (num_players // 2), self._round_name(num_players))
             num_players = num_players // 2
 
+    @staticmethod
+    def _round_robin(teams):
+        """Pairs every two teams once with the circle method: the first team
+        stays put while the others rotate one place a week. Returns the weeks
+        as lists of (home, away); with an odd number of teams one of them sits
+        out each week. Every team's home and away counts differ by at most one."""
+        teams = list(teams)
+        if len(teams) % 2:
+            teams.append(None)  # the team drawn against None has a bye
+        fixed, rotating = teams[0], teams[1:]
+        weeks = []
+        for week in range(len(teams) - 1):
+            order = [fixed] + rotating
+            pairs = [(order[i], order[-1 - i]) for i in range(len(order) // 2)]
+            # a rotating team plays home on one half of the circle and away on the other;
+            # the fixed team switches sides every week
+            if week % 2:
+                pairs[0] = pairs[0][::-1]
+            weeks.append([(home, away) for home, away in pairs if home is not None and away is not None])
+            rotating = rotating[-1:] + rotating[:-1]
+        return weeks
+
+    def create_schedule(self, start_date, double=False, interval=timedelta(weeks=1), notify=True):
+        """Creates a round robin between the teams of the round, one week of
+        matches every ``interval`` from ``start_date``. A double round robin
+        plays every pairing again with the sides switched. Each match gets the
+        tournament's ``games_per_match`` games, on maps rotated through its map
+        pool week by week, with the last game as the ace. The matches and games
+        are inserted in bulk in one transaction. Returns the new matches."""
+        tournament = self.tournament
+        maps = list(tournament.map_pool.order_by('name'))
+        if not maps:
+            raise ValidationError(u"{0} has no maps in its map pool".format(tournament))
+        teams = self.team_membership.order_by('team__seed', 'team').values_list('team', flat=True)
+        weeks = self._round_robin(teams)
+        if double:
+            weeks += [[(away, home) for home, away in week] for week in weeks]
+        # team matches have no lineups to submit
+        submitted = tournament.structure == "T"
+        matches, week_of = [], {}
+        for number, week in enumerate(weeks):
+            week_of[start_date + interval * number] = number
+            matches.extend(Match(tournament=tournament, tournament_round=self, home_team_id=home, away_team_id=away,
+                                 creation_date=start_date + interval * number, structure=tournament.structure,
+                                 home_submitted=submitted, away_submitted=submitted)
+                           for home, away in week)
+        per_match = tournament.games_per_match
+
+        def games(match):
+            first = week_of[match.creation_date] * per_match
+            return [{'map': maps[(first + i) % len(maps)], 'is_ace': per_match > 1 and i == per_match - 1}
+                    for i in range(per_match)]
+        with transaction.commit_on_success():
+            Match.bulk_create_with_games(matches, games, notify=notify)
+        return matches
+
     def participants(self):
         queryset = self.team_membership.select_related('team')
         if self.structure == "G":
@@ -235,22 +339,42 @@ class Match(models.Model):
             else:
                 raise ValidationError("Winner must be one of the teams playing")
 
-    def remove_extra_victories(self):
-        """only count the games that matter to win and set the others to have no winner"""
+    def remove_extra_victories(self, update_stats=True):
+        """only count the games that matter to win and set the others to have no winner.
+        update_stats=False leaves the tiebreakers to imports that recompute all stats at the end"""
         games = list(self.games.all())
         home_wins, away_wins = 0, 0
         win_point = (len(games) // 2) + 1
+        extra = []
         for game in games:
             # if someone already has the games to win (not counting this one) - this game does not matter
-            if (home_wins >= win_point or away_wins >= win_point) and (game.winner or game.winner_team):
-                game.winner = None
-                game.winner_team = None
-                game.full_clean()
-                game.save()
-            if game.winner_team == self.home_team:
+            if (home_wins >= win_point or away_wins >= win_point) and (game.winner_id or game.winner_team_id):
+                game.winner = game.loser = game.winner_team = game.loser_team = None
+                extra.append(game.pk)
+            if game.winner_team_id == self.home_team_id:
                 home_wins += 1
             else:
                 away_wins += 1
+        if not extra:
+            return
+        # one UPDATE instead of a save per game, each of which recounted the match
+        Game.objects.filter(pk__in=extra).update(winner=None, loser=None, winner_team=None, loser_team=None)
+        home_games = len([g for g in games if (g.winner_id and g.home_player_id == g.winner_id) or self.home_team_id == g.winner_team_id])
+        away_games = len([g for g in games if (g.winner_id and g.away_player_id == g.winner_id) or self.away_team_id == g.winner_team_id])
+        if home_games > len(games) // 2:
+            winner = self.home_team
+        elif away_games > len(games) // 2:
+            winner = self.away_team
+        else:
+            winner = self.winner
+        if winner != self.winner:
+            self.winner = winner
+            self.full_clean()
+            self.save()  # recomputes the stats through the post_save receivers
+        else:
+            if update_stats:
+                self.update_tiebreaker()
+            bump_versions(match_version_key(self.pk), tournament_version_key(self.tournament_id))
 
     def save(self, notify=True, *args, **kwargs):
         created = self.id is None
@@ -264,6 +388,41 @@ class Match(models.Model):
                                                                   self.home_team_id,
                                                                   self.away_team_id, ])
 
+    @classmethod
+    def bulk_create_with_games(cls, matches, games, notify=True):
+        """Inserts the unsaved ``matches`` and, for each of them, a game per
+        dict of Game fields in ``games`` (numbered from 1), with one bulk insert
+        each. ``games`` may also be a function returning those dicts for a
+        match, for matches that do not all play the same maps. bulk_create
+        does not set primary keys, so the new matches are read back by round,
+        teams and creation date and get their pk set. The per row save work is
+        skipped: fresh unpublished matches have no stats to recompute, and a
+        single notification job covers the whole batch."""
+        if not matches:
+            return matches
+        cls.objects.bulk_create(matches)
+        created = defaultdict(list)
+        for pk, round_id, home_id, away_id in (cls.objects.filter(tournament_round__in=set(match.tournament_round_id for match in matches),
+                                                                  creation_date__in=set(match.creation_date for match in matches))
+                                                          .order_by('pk').values_list('pk', 'tournament_round', 'home_team', 'away_team')):
+            created[round_id, home_id, away_id].append(pk)
+        batch = defaultdict(list)
+        for match in matches:
+            batch[match.tournament_round_id, match.home_team_id, match.away_team_id].append(match)
+        for key, batch_matches in batch.iteritems():
+            # the new rows are the newest of their key
+            for match, pk in zip(batch_matches, created[key][-len(batch_matches):]):
+                match.pk = pk
+        games_of = games if callable(games) else lambda match: games
+        Game.objects.bulk_create([Game(match_id=match.pk, order=order, **fields)
+                                  for match in matches
+                                  for order, fields in enumerate(games_of(match), start=1)])
+        bump_versions(*set(tournament_version_key(match.tournament_id) for match in matches))
+        if "notification" in settings.INSTALLED_APPS and notification and notify:
+            send_task("tournaments.tasks.notify_match_creations", [[(unicode(match), match.home_team_id, match.away_team_id)
+                                                                    for match in matches]])
+        return matches
+
     def delete(self, *args, **kwargs):
         """Note this doesn't get called in bulk delete!"""
         ret = super(Match, self).delete(*args, **kwargs)
@@ -441,6 +600,38 @@ def update_tiebreaker(sender, instance, created, **kwargs):
     instance.update_tiebreaker()
 
 
+@receiver(post_save, sender=Tournament, dispatch_uid="tournaments_tournament_saved_bump_version")
+def bump_tournament_version(sender, instance, **kwargs):
+    bump_versions(tournament_version_key(instance.pk))
+
+
+@receiver(post_save, sender=TournamentRound, dispatch_uid="tournaments_round_saved_bump_version")
+@receiver(post_delete, sender=TournamentRound, dispatch_uid="tournaments_round_deleted_bump_version")
+def bump_round_version(sender, instance, **kwargs):
+    bump_versions(tournament_version_key(instance.tournament_id))
+
+
+@receiver(post_save, sender=Match, dispatch_uid="tournaments_match_saved_bump_version")
+@receiver(post_delete, sender=Match, dispatch_uid="tournaments_match_deleted_bump_version")
+def bump_match_version(sender, instance, signal=None, **kwargs):
+    if delete_receiver_deferred(signal):
+        return
+    bump_versions(match_version_key(instance.pk), tournament_version_key(instance.tournament_id))
+
+
+@receiver(post_save, sender=Game, dispatch_uid="tournaments_game_saved_bump_version")
+@receiver(post_delete, sender=Game, dispatch_uid="tournaments_game_deleted_bump_version")
+def bump_game_version(sender, instance, signal=None, **kwargs):
+    if delete_receiver_deferred(signal):
+        return
+    keys = [match_version_key(instance.match_id)]
+    try:
+        keys.append(tournament_version_key(instance.match.tournament_id))
+    except Match.DoesNotExist:  # deleted along with its match
+        pass
+    bump_versions(*keys)
+
+
 class GamePluginModel(CMSPlugin):
     tournament = models.ForeignKey('Tournament')
     game = models.ForeignKey('Game', blank=True, null=True)
@@ -1,19 +1,141 @@
+from collections import defaultdict
+
 from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Count
 from celery.task import task
-from notification import models as notification
 
-from .models import TeamRoundMembership
+from profiles.models import (Team, TeamMembership, team_cache, bump_team_versions, clear_captain_dashboards,
+                             clear_open_match_queues)
+from utils.notices import EmailsNotSent, send_notices
+from utils.versions import bump_versions
+from .models import (Match, Game, TeamRoundMembership, delete_receivers_deferred, match_version_key,
+                     tournament_version_key)
 
 
 @task(ignore_result=True)
 def notify_match_creation(match, home_team, away_team):
-    notification.send((User.objects.exclude(username='master')
-                       .filter(profile__teams__pk__in=(home_team, away_team))),
-                      "tournaments_new_match",
-                      {'match': unicode(match)})
+    notify_match_creations.delay([(match, home_team, away_team)])
+
+
+@task(ignore_result=True, max_retries=5)
+def notify_match_creations(matches, user_ids=None):
+    """matches is a list of (match name, home team id, away team id). Every
+    member of the teams gets one notice listing all of their new matches.
+    A retry only emails ``user_ids``, the members whose email failed."""
+    matches_by_team = defaultdict(list)
+    for match, home_team, away_team in matches:
+        matches_by_team[home_team].append(match)
+        matches_by_team[away_team].append(match)
+    users, matches_by_user = {}, defaultdict(list)
+    memberships = (TeamMembership.objects.filter(team__in=matches_by_team.keys())
+                                         .exclude(profile__user__username='master')
+                                         .select_related('profile__user'))
+    if user_ids is not None:
+        memberships = memberships.filter(profile__user__in=user_ids)
+    for membership in memberships:
+        user = membership.profile.user
+        users[user.pk] = user
+        for match in matches_by_team[membership.team_id]:
+            if match not in matches_by_user[user.pk]:
+                matches_by_user[user.pk].append(match)
+    try:
+        send_notices("tournaments_new_match", [(user, {'matches': matches_by_user[pk]}) for pk, user in users.iteritems()],
+                     emails_only=user_ids is not None)
+    except EmailsNotSent as e:
+        raise notify_match_creations.retry(args=[matches, e.user_ids], exc=e.error,
+                                           countdown=60 * 2 ** notify_match_creations.request.retries)
+
+
+@task(ignore_result=True, max_retries=5)
+def notify_lineup_ready(match_pk, user_ids=None):
+    """A retry only emails ``user_ids``, the members whose email failed."""
+    try:
+        match = Match.objects.select_related('tournament', 'home_team', 'away_team').get(pk=match_pk)
+    except Match.DoesNotExist:
+        return
+    # a member of both teams is notified once
+    users = (User.objects.exclude(username='master')
+                         .filter(profile__teams__pk__in=(match.home_team_id, match.away_team_id))
+                         .distinct())
+    if user_ids is not None:
+        users = users.filter(pk__in=user_ids)
+    try:
+        send_notices("tournaments_lineup_ready", [(user, {'match': match}) for user in users],
+                     emails_only=user_ids is not None)
+    except EmailsNotSent as e:
+        raise notify_lineup_ready.retry(args=[match_pk, e.user_ids], exc=e.error,
+                                        countdown=60 * 2 ** notify_lineup_ready.request.retries)
 
 
 @task(ignore_result=True)
 def update_round_stats(tournament_pk):
     for membership in TeamRoundMembership.objects.filter(tournamentround__tournament=tournament_pk):
         membership.update_stats()
+
+
+@task(ignore_result=True)
+def delete_matches(match_pks):
+    """Deletes the matches and their games in one transaction, then repairs the
+    stats of the teams and round memberships they counted towards."""
+    tournament_ids = set(Match.objects.filter(pk__in=match_pks).values_list('tournament', flat=True))
+    pairs = set(Match.objects.filter(pk__in=match_pks).values_list('tournament_round', 'home_team')) \
+          | set(Match.objects.filter(pk__in=match_pks).values_list('tournament_round', 'away_team'))
+    with transaction.commit_on_success():
+        with delete_receivers_deferred():
+            Match.objects.filter(pk__in=match_pks).delete()
+        changed = repair_stats(pairs)
+    # update() and the deferred receivers skipped the caches, which are only dropped once committed
+    team_cache.invalidate_pks([pk for pk, tournament_id, slug in changed])
+    bump_team_versions([(tournament_id, slug) for pk, tournament_id, slug in changed])
+    bump_versions(*[match_version_key(pk) for pk in match_pks] +
+                   [tournament_version_key(tournament_id) for tournament_id in tournament_ids])
+    clear_captain_dashboards(set(team for round_id, team in pairs))
+    clear_open_match_queues(tournament_ids)
+
+
+def repair_stats(pairs):
+    """Recomputes the wins, losses and tiebreakers of the teams and round
+    memberships in ``pairs``, a set of (tournament round id, team id), with one
+    grouped count per stat. Only the rows whose stats changed are updated; a
+    pair with no round only repairs the team. Returns the (pk, tournament id,
+    slug) of the updated teams."""
+    team_ids = set(team for round_id, team in pairs)
+    if not team_ids:
+        return []
+    # (round id, team id) -> count of published matches and games
+    counts = dict((stat, defaultdict(int)) for stat in ('wins', 'losses', 'game_wins', 'game_losses'))
+    for stat, queryset, round_field, team_field in (
+            ('wins', Match.objects.filter(published=True), 'tournament_round', 'winner'),
+            ('losses', Match.objects.filter(published=True), 'tournament_round', 'loser'),
+            ('game_wins', Game.objects.filter(match__published=True), 'match__tournament_round', 'winner_team'),
+            ('game_losses', Game.objects.filter(match__published=True), 'match__tournament_round', 'loser_team')):
+        for round_id, team, total in (queryset.filter(**{team_field + '__in': team_ids})
+                                              .values_list(round_field, team_field)
+                                              .annotate(Count('pk')).order_by()):
+            counts[stat][round_id, team] = total
+
+    totals = defaultdict(lambda: defaultdict(int))
+    for stat, by_pair in counts.iteritems():
+        for (round_id, team), total in by_pair.iteritems():
+            totals[team][stat] += total
+
+    changed = []
+    for pk, tournament_id, slug, wins, losses, tiebreaker in (Team.objects.filter(pk__in=team_ids)
+                                                                          .values_list('pk', 'tournament', 'slug', 'wins', 'losses', 'tiebreaker')):
+        stats = totals[pk]
+        new = (stats['wins'], stats['losses'], stats['game_wins'] - stats['game_losses'])
+        if new != (wins, losses, tiebreaker):
+            Team.objects.filter(pk=pk).update(wins=new[0], losses=new[1], tiebreaker=new[2])
+            changed.append((pk, tournament_id, slug))
+
+    for pk, round_id, team, wins, losses, tiebreaker in (TeamRoundMembership.objects.filter(team__in=team_ids,
+                                                                                            tournamentround__in=set(round_id for round_id, team in pairs if round_id))
+                                                                                    .values_list('pk', 'tournamentround', 'team', 'wins', 'losses', 'tiebreaker')):
+        key = (round_id, team)
+        if key not in pairs:
+            continue
+        new = (counts['wins'][key], counts['losses'][key], counts['game_wins'][key] - counts['game_losses'][key])
+        if new != (wins, losses, tiebreaker):
+            TeamRoundMembership.objects.filter(pk=pk).update(wins=new[0], losses=new[1], tiebreaker=new[2])
+    return changed
@@ -5,7 +5,33 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
+import os
+import re
+import shutil
+import tempfile
+import threading
+from collections import defaultdict
+from datetime import timedelta
+from itertools import count
+from StringIO import StringIO
+
+from django.conf import settings
+from django.contrib.auth.models import Permission, User
+from django.core import mail
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.db.models import F
+from django.db.models.signals import post_delete
 from django.test import TestCase
+from django.utils import timezone
+
+from notification import models as notification
+
+from profiles.models import Profile, Team, TeamMembership, open_match_queue
+from . import models, tasks, views
+from .models import (Tournament, TournamentRound, TeamRoundMembership, Match, Map, Game, match_version_key,
+                     tournament_version_key)
 
 
 class SimpleTest(TestCase):
@@ -14,3 +40,546 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class SubmitLineupTest(TestCase):
+    def setUp(self):
+        build_tournament(teams=2, members=2, rounds=1, games=1)
+        Match.objects.update(published=False, home_submitted=False, away_submitted=True)
+        Game.objects.update(winner=None, loser=None, winner_team=None, loser_team=None)
+        self.match = Match.objects.get()
+        self.game = self.match.games.get()
+        self.player = self.match.home_team.team_membership.get(captain=True)
+        self.captain = self.player.profile.user
+        self.captain.set_password("captain")
+        self.captain.save()
+
+    def test_lineup_ready_is_queued(self):
+        sent, rendered = [], []
+        old_send_task, old_get_formatted_messages = views.send_task, notification.get_formatted_messages
+        views.send_task = lambda name, args: sent.append((name, args))
+        notification.get_formatted_messages = lambda *args: rendered.append(args)
+        try:
+            self.client.login(username=self.captain.username, password="captain")
+            response = self.client.post(reverse("submit_lineup", kwargs={'pk': self.match.pk}), {
+                'games-TOTAL_FORMS': 1,
+                'games-INITIAL_FORMS': 1,
+                'games-MAX_NUM_FORMS': '',
+                'games-0-id': self.game.pk,
+                'games-0-match': self.match.pk,
+                'games-0-home_player': self.player.pk,
+                'games-0-home_race': "P",
+            })
+        finally:
+            views.send_task, notification.get_formatted_messages = old_send_task, old_get_formatted_messages
+        self.assertRedirects(response, reverse("player_admin"))
+        self.assertEqual(sent, [("tournaments.tasks.notify_lineup_ready", [self.match.pk])])
+        self.assertEqual(rendered, [])
+        self.assertEqual(notification.Notice.objects.count(), 0)
+
+
+class MatchReportFormTest(TestCase):
+    games = 7
+    members = 8
+
+    def setUp(self):
+        build_tournament(teams=2, members=self.members, rounds=1, games=self.games)
+        Match.objects.update(published=False)
+        Game.objects.update(winner=None, loser=None, winner_team=None, loser_team=None)
+        Game.objects.filter(order=self.games).update(is_ace=True, home_player=None, away_player=None)
+        self.match = views.MatchReportView.queryset.get()
+
+    def test_fixed_queries(self):
+        view = views.MatchReportView()
+        view.object = self.match
+        with self.assertNumQueries(2):
+            form = view.get_form_class()(instance=self.match)
+            html = form.as_table()
+        games = form.forms[0].forms
+        first = Game.objects.select_related('home_player', 'away_player').get(order=1)
+        self.assertEqual(len(games), self.games)
+        self.assertEqual([choice[1] for choice in games[0].fields['winner'].choices],
+                         ["Not played", first.home_player.char_name, first.away_player.char_name])
+        self.assertEqual(len(games[-1].fields['winner'].choices), self.members * 2 + 1)
+        # a captain who plays none of the games is only offered for the ace
+        self.assertTrue(self.match.home_team.team_membership.get(captain=True).char_name in html)
+
+
+class RecordQueries(object):
+    def __enter__(self):
+        self.old_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        self.start = len(connection.queries)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.queries = connection.queries[self.start:]
+        connection.use_debug_cursor = self.old_debug_cursor
+
+    @property
+    def time(self):
+        return sum(float(query['time']) for query in self.queries)
+
+    def offenders(self, top=5):
+        """The statements run most often once literals are stripped, as (count, total time, sql)"""
+        grouped = defaultdict(list)
+        for query in self.queries:
+            grouped[re.sub(r"'[^']*'|\b\d+\b", "?", query['sql'])].append(float(query['time']))
+        return sorted(((len(times), sum(times), sql) for sql, times in grouped.iteritems()), reverse=True)[:top]
+
+
+def build_tournament(slug="season-1", teams=8, members=8, rounds=2, games=5):
+    """A tournament shaped like a real season: every team plays every other
+    team of its round once, with a full roster on each side of every game."""
+    tournament = Tournament.objects.create(slug=slug, name=slug.title(), games_per_match=games)
+    maps = [Map.objects.create(name="{0} map {1}".format(slug, i)) for i in range(games)]
+    tournament.map_pool = maps
+    users = count()
+    for round_order in range(1, rounds + 1):
+        tournament_round = TournamentRound.objects.create(tournament=tournament, order=round_order, stage_order=1, stage_name="Groups")
+        round_teams = []
+        for i in range(teams // rounds):
+            team = Team.objects.create(tournament=tournament, name="Team {0}-{1}".format(round_order, i), slug="team-{0}-{1}".format(round_order, i))
+            TeamRoundMembership.objects.create(tournamentround=tournament_round, team=team)
+            roster = []
+            for j in range(members):
+                user = User.objects.create(username="{0}-{1}".format(slug, next(users)))
+                profile = Profile.objects.create(user=user, name=user.username)
+                roster.append(TeamMembership.objects.create(team=team, profile=profile, char_name=user.username, char_code=j, captain=j == 0))
+            round_teams.append((team, roster))
+        for home, (home_team, home_roster) in enumerate(round_teams):
+            for away_team, away_roster in round_teams[home + 1:]:
+                match = Match(tournament=tournament, tournament_round=tournament_round, home_team=home_team, away_team=away_team,
+                              creation_date=timezone.now(), home_submitted=True, away_submitted=True, published=True)
+                match.save(notify=False)
+                for order, map in enumerate(maps, start=1):
+                    winner, loser = (home_roster[order], away_roster[order]) if order % 2 else (away_roster[order], home_roster[order])
+                    Game.objects.create(match=match, map=map, order=order, home_player=home_roster[order], away_player=away_roster[order],
+                                        winner=winner, loser=loser, winner_team=winner.team, loser_team=loser.team)
+    return tournament
+
+
+class AdminQueryBudgetTest(TestCase):
+    """Fails when an admin page runs more queries for a bigger season, which is
+    how N+1 regressions show up. Run with ADMIN_QUERY_REPORT=1 to print every
+    page's query count, time and the statements it repeats most."""
+    # (url name, function of the season returning the url args)
+    pages = (
+        ("admin:tournaments_tournament_changelist", None),
+        ("admin:tournaments_tournament_change", lambda season: [season['tournament'].pk]),
+        ("admin:tournaments_match_changelist", None),
+        ("admin:tournaments_match_change", lambda season: [season['match'].pk]),
+        ("admin:profiles_team_changelist", None),
+        ("admin:profiles_team_change", lambda season: [season['match'].home_team_id]),
+        ("admin:profiles_teammembership_changelist", None),
+        ("admin:profiles_teammembership_change", lambda season: [season['membership'].pk]),
+        ("admin:profiles_profile_changelist", None),
+        ("admin:profiles_profile_change", lambda season: [season['membership'].profile_id]),
+    )
+
+    def setUp(self):
+        User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client.login(username="admin", password="admin")
+
+    def season(self, **sizes):
+        tournament = build_tournament(**sizes)
+        match = Match.objects.filter(tournament=tournament)[0]
+        return {'tournament': tournament, 'match': match,
+                'membership': TeamMembership.objects.filter(team=match.home_team_id)[0]}
+
+    def load(self, name, args, season):
+        url = reverse(name, args=args(season) if args else None)
+        cache.clear()
+        with RecordQueries() as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200, url)
+        if os.environ.get('ADMIN_QUERY_REPORT'):
+            print("\n{0}: {1} queries in {2:.3f}s".format(url, len(queries.queries), queries.time))
+            for times, total, sql in queries.offenders():
+                print("  {0}x {1:.3f}s {2}".format(times, total, sql[:300]))
+        return response, len(queries.queries)
+
+    def test_queries_do_not_grow(self):
+        small = self.season(slug="small", teams=4, members=4, rounds=1, games=3)
+        counts = dict((name, self.load(name, args, small)[1]) for name, args in self.pages)
+        large = self.season(slug="large", teams=16, members=12, rounds=2, games=7)
+        grown = []
+        for name, args in self.pages:
+            count = self.load(name, args, large)[1]
+            if count > counts[name]:
+                grown.append("{0}: {1} queries, {2} for the small season".format(name, count, counts[name]))
+        self.assertFalse(grown, "\n".join(grown))
+
+    def inline_formset(self, response, model):
+        return [inline.formset for inline in response.context['inline_admin_formsets'] if inline.formset.model is model][0]
+
+    def test_inlines_show_their_rows(self):
+        season = self.season(teams=4, members=6, rounds=1, games=5)
+        match, tournament = season['match'], season['tournament']
+        response = self.load("admin:tournaments_match_change", lambda season: [season['match'].pk], season)[0]
+        games = self.inline_formset(response, Game)
+        self.assertEqual([form.instance.pk for form in games.initial_forms], list(match.games.values_list('pk', flat=True)))
+        response = self.load("admin:tournaments_tournament_change", lambda season: [season['tournament'].pk], season)[0]
+        rounds = self.inline_formset(response, TournamentRound)
+        self.assertEqual(sorted(form.instance.pk for form in rounds.initial_forms),
+                         sorted(tournament.rounds.values_list('pk', flat=True)))
+        self.assertEqual(sorted(team.pk for team in rounds.initial_forms[0].fields['teams'].queryset),
+                         sorted(Team.objects.filter(tournament=tournament).values_list('pk', flat=True)))
+
+
+class RemoveExtraVictoriesTest(TestCase):
+    def setUp(self):
+        self.tournament = build_tournament(teams=2, members=8, rounds=1, games=7)
+        self.match = Match.objects.get(tournament=self.tournament)
+
+    def set_winners(self, sides):
+        """sides is a string of H (home won), A (away won) or - (not played) per game"""
+        for game, side in zip(self.match.games.all(), sides):
+            game.winner = {'H': game.home_player, 'A': game.away_player}.get(side)
+            game.full_clean()
+            game.save()
+        return Match.objects.get(pk=self.match.pk)
+
+    def winners(self):
+        match = Match.objects.get(pk=self.match.pk)
+        return "".join({match.home_team_id: 'H', match.away_team_id: 'A'}.get(game.winner_team_id, '-')
+                       for game in match.games.all())
+
+    def test_clears_games_past_the_win_point(self):
+        match = self.set_winners("HHAHHAH")
+        match.remove_extra_victories()
+        self.assertEqual(self.winners(), "HHAHH--")
+        match = Match.objects.get(pk=self.match.pk)
+        self.assertEqual(match.winner_id, match.home_team_id)
+        self.assertEqual(match.home_team.tiebreaker, 3)
+        self.assertEqual(match.away_team.tiebreaker, -3)
+        self.assertEqual(TeamRoundMembership.objects.get(team=match.home_team_id).tiebreaker, 3)
+        self.assertFalse(Game.objects.filter(match=match, winner_team=None).exclude(loser=None).exists())
+
+    def test_keeps_deciding_games(self):
+        match = self.set_winners("HAHAHAH")
+        with self.assertNumQueries(1):
+            match.remove_extra_victories()
+        self.assertEqual(self.winners(), "HAHAHAH")
+
+
+class DeleteMatchesTest(TestCase):
+    def setUp(self):
+        self.tournament = build_tournament(teams=4, members=6, rounds=1, games=5)
+        for team in Team.objects.filter(tournament=self.tournament):
+            team.update_stats()
+        for membership in TeamRoundMembership.objects.all():
+            membership.update_stats()
+
+    def stats(self):
+        return (sorted(Team.objects.filter(tournament=self.tournament).values_list('pk', 'wins', 'losses', 'tiebreaker')),
+                sorted(TeamRoundMembership.objects.values_list('pk', 'wins', 'losses', 'tiebreaker')))
+
+    def test_repairs_stats_like_update_stats(self):
+        deleted = list(Match.objects.filter(tournament=self.tournament).values_list('pk', flat=True)[:2])
+        tasks.delete_matches(deleted)
+        self.assertFalse(Match.objects.filter(pk__in=deleted).exists())
+        self.assertFalse(Game.objects.filter(match__in=deleted).exists())
+        repaired = self.stats()
+        for team in Team.objects.filter(tournament=self.tournament):
+            team.update_stats()
+        for membership in TeamRoundMembership.objects.all():
+            membership.update_stats()
+        self.assertEqual(repaired, self.stats())
+
+    def test_bumps_versions_once(self):
+        cache.clear()
+        deleted = list(Match.objects.filter(tournament=self.tournament).values_list('pk', flat=True)[:2])
+        bumped = []
+        old_bump_versions = tasks.bump_versions
+        tasks.bump_versions = lambda *keys: bumped.append(set(keys))
+        try:
+            tasks.delete_matches(deleted)
+        finally:
+            tasks.bump_versions = old_bump_versions
+        self.assertEqual(bumped, [set([match_version_key(pk) for pk in deleted] + [tournament_version_key(self.tournament.pk)])])
+        # the per match receivers were skipped, and are connected again afterwards
+        self.assertEqual(cache.get_many([match_version_key(pk) for pk in deleted]), {})
+        match = Match.objects.filter(tournament=self.tournament)[0]
+        match.delete()
+        self.assertTrue(cache.get(match_version_key(match.pk)))
+
+    def test_other_threads_run_the_receivers(self):
+        deferred = []
+        other = threading.Thread(target=lambda: deferred.append(models.delete_receiver_deferred(post_delete)))
+        with models.delete_receivers_deferred():
+            other.start()
+            other.join()
+            self.assertTrue(models.delete_receiver_deferred(post_delete))
+        self.assertEqual(deferred, [False])
+        self.assertFalse(models.delete_receiver_deferred(post_delete))
+
+    def test_admin_needs_permission_for_the_games(self):
+        user = User.objects.create_user("staff", "staff@example.com", "staff")
+        user.is_staff = True
+        user.save()
+        user.user_permissions = Permission.objects.filter(codename__in=("change_match", "delete_match"))
+        self.client.login(username="staff", password="staff")
+        match = Match.objects.filter(tournament=self.tournament)[0]
+        response = self.client.post(reverse("admin:tournaments_match_changelist"), {
+            'action': "delete_and_update_stats", '_selected_action': [match.pk], 'post': "yes"})
+        self.assertEqual(response.status_code, 403)
+        self.assertTrue(Match.objects.filter(pk=match.pk).exists())
+
+
+class VersionedPagesTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.tournament = build_tournament(teams=2, members=6, rounds=1, games=5)
+        self.match = Match.objects.get(tournament=self.tournament)
+        self.urls = [reverse("team_page", kwargs={'tournament': self.tournament.slug, 'slug': self.match.home_team.slug}),
+                     reverse("standings", kwargs={'tournament': self.tournament.slug})]
+
+    def etags(self):
+        etags = []
+        for url in self.urls:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag']).status_code, 304)
+            etags.append(response['ETag'])
+        return etags
+
+    def assertEtagsChange(self, change):
+        before = self.etags()
+        change()
+        for old, new, url in zip(before, self.etags(), self.urls):
+            self.assertNotEqual(old, new, url)
+
+    def test_match_save(self):
+        self.assertEtagsChange(lambda: self.match.save(notify=False))
+
+    def test_remove_extra_victories(self):
+        # the home team wins every game, so the last two do not count
+        self.match.games.update(winner=F('home_player'), loser=F('away_player'),
+                                winner_team=self.match.home_team, loser_team=self.match.away_team)
+        self.assertEtagsChange(self.match.remove_extra_victories)
+        self.assertEqual(self.match.games.filter(winner_team__isnull=False).count(), 3)
+
+
+class NotifyMatchCreationsTest(TestCase):
+    def setUp(self):
+        build_tournament(teams=3, members=2, rounds=1, games=1)
+        User.objects.update(email="player@example.com")
+        notice_type, created = notification.NoticeType.objects.get_or_create(label="tournaments_new_match", defaults={
+            'display': "New Match", 'description': "a match was scheduled for your team"})
+        notice_type.default = notification.NOTICE_MEDIA_DEFAULTS["1"]
+        notice_type.save()
+        self.teams = list(Team.objects.order_by('slug'))
+        master = Profile.objects.create(user=User.objects.create(username="master", email="master@example.com"), name="Master")
+        TeamMembership.objects.create(team=self.teams[0], profile=master, char_name="master")
+        self.quiet = self.teams[0].team_membership.get(captain=False).profile.user
+        notification.NoticeSetting.objects.create(user=self.quiet, notice_type=notice_type, medium="1", send=False)
+
+    def test_one_digest_per_member(self):
+        old_get_formatted_messages = notification.get_formatted_messages
+        notification.get_formatted_messages = lambda formats, label, context: dict.fromkeys(formats, u", ".join(context['matches']))
+        try:
+            tasks.notify_match_creations([("first", self.teams[0].pk, self.teams[1].pk),
+                                          ("second", self.teams[0].pk, self.teams[2].pk)])
+        finally:
+            notification.get_formatted_messages = old_get_formatted_messages
+        notices = dict((notice.recipient.username, notice.message) for notice in notification.Notice.objects.select_related('recipient'))
+        self.assertEqual(notification.Notice.objects.count(), 6)
+        self.assertFalse("master" in notices)
+        for membership in self.teams[0].team_membership.exclude(char_name="master").select_related('profile__user'):
+            self.assertEqual(notices[membership.profile.user.username], u"first, second")
+        self.assertEqual(notices[self.teams[1].team_membership.all()[0].profile.user.username], u"first")
+        self.assertEqual(len(mail.outbox), 5)
+        # the member of both matches' team who turned emails off only gets the notice
+        self.assertEqual(sum(1 for message in mail.outbox if "first, second" in message.body), 1)
+
+
+class OpenMatchQueueTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.tournament = build_tournament(teams=4, members=4, rounds=1, games=3)
+        Match.objects.update(published=False, home_submitted=False, away_submitted=False)
+        self.team = Team.objects.get(slug="team-1-0")
+        self.user = self.team.team_membership.get(captain=True).profile.user
+
+    def test_lists_own_matches_and_reportable_ones(self):
+        queue = open_match_queue(self.user)
+        self.assertEqual(len(queue), 3)
+        self.assertTrue(all(match.pending == 'lineup' and match.role for match in queue))
+        with self.assertNumQueries(0):
+            open_match_queue(self.user)
+
+        other = Match.objects.exclude(home_team=self.team).exclude(away_team=self.team)[0]
+        other.home_submitted = other.away_submitted = True
+        other.save()
+        queue = open_match_queue(self.user)
+        self.assertEqual([(match.role, match.pending) for match in queue if match.pk == other.pk], [(None, 'report')])
+
+    def test_saves_clear_the_teams_until_reportable(self):
+        open_match_queue(self.user)
+        other = Match.objects.exclude(home_team=self.team).exclude(away_team=self.team)[0]
+        other.home_submitted = True
+        other.save()
+        with self.assertNumQueries(0):
+            open_match_queue(self.user)
+        other.away_submitted = True
+        other.save()
+        self.assertEqual([match.pending for match in open_match_queue(self.user) if match.pk == other.pk], ['report'])
+
+    def test_player_admin_view(self):
+        self.user.set_password("password")
+        self.user.save()
+        self.client.login(username=self.user.username, password="password")
+        own = Match.objects.filter(home_team=self.team)[0]
+        own.home_submitted = own.away_submitted = True
+        own.save()
+        response = self.client.get(reverse("player_admin"))
+        self.assertEqual(len(response.context['team_matches']), 3)
+        self.assertEqual([match.pk for match in response.context['report_match_list']], [own.pk])
+
+
+class BulkCreateWithGamesTest(TestCase):
+    def setUp(self):
+        self.tournament = build_tournament(teams=3, members=3, rounds=1, games=2)
+        self.teams = dict((team.slug, team) for team in Team.objects.filter(tournament=self.tournament))
+        self.existing = Match.objects.get(home_team=self.teams["team-1-0"], away_team=self.teams["team-1-1"])
+
+    def test_pairing_already_in_the_round(self):
+        maps = list(self.tournament.map_pool.order_by('name'))
+        # the same pairing a week later, and another pairing on the day of the existing match, so it is read back too
+        matches = [Match(tournament=self.tournament, tournament_round=self.existing.tournament_round, home_team=home, away_team=away,
+                         creation_date=date)
+                   for home, away, date in ((self.teams["team-1-0"], self.teams["team-1-1"], self.existing.creation_date + timedelta(weeks=1)),
+                                            (self.teams["team-1-1"], self.teams["team-1-2"], self.existing.creation_date))]
+        sent = []
+        old_send_task = models.send_task
+        models.send_task = lambda name, args: sent.append((name, args))
+        try:
+            Match.bulk_create_with_games(matches, [{'map': map} for map in maps])
+        finally:
+            models.send_task = old_send_task
+        for match in matches:
+            saved = Match.objects.get(pk=match.pk)
+            self.assertEqual((saved.home_team_id, saved.away_team_id, saved.creation_date),
+                             (match.home_team_id, match.away_team_id, match.creation_date))
+            self.assertEqual(list(saved.games.values_list('order', 'map')), [(1, maps[0].pk), (2, maps[1].pk)])
+        self.assertNotEqual(matches[0].pk, self.existing.pk)
+        self.assertEqual(self.existing.games.count(), 2)
+        self.assertEqual(sent, [("tournaments.tasks.notify_match_creations",
+                                 [[(unicode(match), match.home_team_id, match.away_team_id) for match in matches]])])
+
+
+class ScheduleTest(TestCase):
+    def test_round_robin_pairs_everyone_once(self):
+        for size in (2, 5, 8, 64):
+            weeks = TournamentRound._round_robin(range(size))
+            pairs = [pair for week in weeks for pair in week]
+            self.assertEqual(len(set(frozenset(pair) for pair in pairs)), size * (size - 1) // 2)
+            self.assertEqual(len(pairs), size * (size - 1) // 2)
+            for week in weeks:
+                teams = [team for pair in week for team in pair]
+                self.assertEqual(len(teams), len(set(teams)))
+            homes = defaultdict(int)
+            for home, away in pairs:
+                homes[home] += 1
+                homes[away] -= 1
+            self.assertTrue(all(abs(balance) <= 1 for balance in homes.values()))
+
+    def test_create_schedule(self):
+        tournament = Tournament.objects.create(slug="schedule", name="Schedule", games_per_match=3)
+        tournament.map_pool = [Map.objects.create(name="map {0}".format(i)) for i in range(4)]
+        tournament_round = TournamentRound.objects.create(tournament=tournament, order=1, stage_order=1, stage_name="Groups")
+        for i in range(5):
+            team = Team.objects.create(tournament=tournament, name="Team {0}".format(i), slug="team-{0}".format(i))
+            TeamRoundMembership.objects.create(tournamentround=tournament_round, team=team)
+        start = timezone.now().date()
+        matches = tournament_round.create_schedule(start, double=True, notify=False)
+        self.assertEqual(len(matches), 20)
+        self.assertEqual(Match.objects.filter(tournament_round=tournament_round).count(), 20)
+        self.assertEqual(sorted(set(match.creation_date for match in matches)), [start + timedelta(weeks=week) for week in range(10)])
+        self.assertEqual(len(set((match.home_team_id, match.away_team_id) for match in matches)), 20)
+        for match in Match.objects.filter(tournament_round=tournament_round):
+            self.assertEqual([game.is_ace for game in match.games.all()], [False, False, True])
+
+
+class ScrapeIdentityMapTest(TestCase):
+    def setUp(self):
+        self.master = User.objects.create(username="master")
+        self.tournament = build_tournament(teams=2, members=4, rounds=1, games=3)
+        self.home, self.away = Team.objects.filter(tournament=self.tournament).order_by('slug')
+
+    def test_resolves_without_queries(self):
+        # the command looks the master user up when it is imported
+        from .management.commands.scrape_ahgl import IdentityMap
+        entities = IdentityMap(self.tournament, self.master)
+        match = Match.objects.get(tournament=self.tournament)
+        member = TeamMembership.objects.filter(team=self.home)[0]
+        game = match.games.select_related('map').get(order=1)
+        with self.assertNumQueries(0):
+            self.assertEqual(entities.team_by_slug(self.home.slug), self.home)
+            self.assertEqual(entities.team_by_name(self.away.name), self.away)
+            self.assertEqual(entities.member(self.home, member.char_name.upper()), member)
+            self.assertEqual(entities.player(member.char_name, member.char_code, (self.away, self.home)), member)
+            self.assertEqual(entities.match(match.home_team, match.away_team, match.creation_date), match)
+            self.assertEqual(entities.saved_game(match, 1), game)
+            self.assertEqual(entities.map(game.map.name), (game.map, False))
+
+    def test_creates_members_in_bulk(self):
+        from .management.commands.scrape_ahgl import IdentityMap
+        entities = IdentityMap(self.tournament, self.master)
+        with self.assertNumQueries(5):
+            entities.create_members([(self.home, "Newcomer"), (self.away, "Newcomer"), (self.home, "newcomer")])
+        self.assertEqual(TeamMembership.objects.filter(char_name="Newcomer").count(), 2)
+        newcomer = entities.member(self.away, "NEWCOMER")
+        self.assertEqual(Profile.objects.get(pk=newcomer.profile_id).name, "Newcomer")
+
+    def test_renamed_member_is_remapped(self):
+        from .management.commands.scrape_ahgl import IdentityMap
+        entities = IdentityMap(self.tournament, self.master)
+        member = TeamMembership.objects.filter(team=self.home)[0]
+        old_char_name = member.char_name
+        renamed = TeamMembership.objects.get(pk=member.pk)
+        renamed.char_name = "Renamed"
+        renamed.save()
+        entities.replace_membership(renamed, old_char_name)
+        self.assertEqual(entities.member(self.home, old_char_name), None)
+        self.assertTrue(entities.member(self.home, "renamed") is renamed)
+        entities.replace_membership(renamed)
+        self.assertEqual(entities.members["renamed"], [renamed])
+
+    def test_stats_repaired_after_error(self):
+        from .management.commands import scrape_ahgl
+        for team in (self.home, self.away):
+            team.update_stats()
+        before = sorted(Team.objects.filter(tournament=self.tournament).values_list('pk', 'wins', 'losses', 'tiebreaker'))
+        schedule = scrape_ahgl.html.fromstring(
+            '<ul><li class="season-list-item"><ul>'
+            '<li class="week-list-item"><a class="week-list-link" href="first">first</a></li>'
+            '<li class="week-list-item"><a class="week-list-link" href="second">second</a></li>'
+            '</ul></li></ul>')
+
+        def load_match(url, week):
+            if url == "second":
+                raise ValueError("unexpected page")
+            match = Match.objects.get(tournament=self.tournament)
+            match.published = False
+            match.save(notify=False)
+
+        command = scrape_ahgl.Command()
+        command.stdout, command.stderr = StringIO(), StringIO()
+        command.visit_url = lambda path, base=None, fresh=False: schedule
+        command.load_match = load_match
+        cache_dir = tempfile.mkdtemp()
+        installed_apps = list(settings.INSTALLED_APPS)
+        try:
+            command.handle(self.tournament.slug, match=True, team=False, admin=False, whole_team=False,
+                           cache_dir=cache_dir, workers=1, offline=True, refresh=False)
+        finally:
+            settings.INSTALLED_APPS[:] = installed_apps
+            shutil.rmtree(cache_dir)
+        self.assertTrue("unexpected page" in command.stderr.getvalue())
+        repaired = sorted(Team.objects.filter(tournament=self.tournament).values_list('pk', 'wins', 'losses', 'tiebreaker'))
+        self.assertNotEqual(repaired, before)
+        for team in Team.objects.filter(tournament=self.tournament):
+            team.update_stats()
+        self.assertEqual(repaired, sorted(Team.objects.filter(tournament=self.tournament).values_list('pk', 'wins', 'losses', 'tiebreaker')))
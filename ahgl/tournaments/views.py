@@ -5,6 +5,7 @@ from django.views.generic import DetailView, ListView, UpdateView
 from django.views.generic.detail import TemplateResponseMixin
 from django.views.generic.edit import FormMixin, ProcessFormView
 from django.forms.models import inlineformset_factory, modelformset_factory, modelform_factory
+from django.db import transaction
 from django.db.models import Q
 from django.utils.decorators import method_decorator
 from django.utils import timezone
@@ -26,13 +27,17 @@ if "notification" in settings.INSTALLED_APPS:
 else:
     notification = None
 from django.utils.datastructures import SortedDict
+from celery.execute import send_task
 
 from utils.views import ObjectPermissionsCheckMixin
-from profiles.models import Profile, RACES, TeamMembership, Team
+from utils.versions import versioned
+from profiles.models import (Profile, RACES, TeamMembership, Team, team_cache,
+                             clear_captain_dashboards, clear_open_match_queues, open_match_queue)
 from profiles.views import TournamentSlugContextView
 
-from .models import Tournament, Match, Game, TournamentRound
-from .forms import BaseMatchFormSet, MultipleFormSetBase
+from .models import (Tournament, Match, Game, TournamentRound, tournament_cache,
+                     tournament_version_key, match_version_key)
+from .forms import BaseMatchFormSet, GameReportFormSet, MultipleFormSetBase, LoadedModelChoiceField
 
 logger = logging.getLogger(__name__)
 
@@ -101,24 +106,23 @@ class NewTournamentRoundView(TemplateResponseMixin, FormMixin, ProcessFormView):
             def save(self, *args, **kwargs):
                 date = self.forms[0].forms[0].cleaned_data.get('play_date', timezone.now())
                 structure = self.forms[0].forms[0].cleaned_data.get('structure', tournament.structure)
+                matches = []
                 for match_formset in self.forms[2:]:
-                    for match_form in match_formset:
-                        match_form.instance.creation_date = date
-                        match_form.instance.structure = structure
-                if structure == "T":  # Team games don't need to submit lineup, so skip this stage
-                    for match_formset in self.forms[2:]:
-                        for match_form in match_formset:
-                            match_form.instance.home_submitted = True
-                            match_form.instance.away_submitted = True
-                ret = super(NewTournamentRoundForm, self).save(*args, **kwargs)
-                map_formset = self.forms[1]
-                for match_formset in self.forms[2:]:
-                    for match_form in match_formset:
-                        if match_form.instance.id:
-                            for i, map_form in enumerate(map_formset, start=1):
-                                if 'map' in map_form.cleaned_data and map_form.cleaned_data['map']:
-                                    match_form.instance.games.create(order=i, **map_form.cleaned_data)
-                return ret
+                    for match_form in match_formset.forms:
+                        if not match_form.has_changed() or match_form in match_formset.deleted_forms:
+                            continue
+                        match = match_form.save(commit=False)
+                        match.creation_date = date
+                        match.structure = structure
+                        if structure == "T":  # Team games don't need to submit lineup, so skip this stage
+                            match.home_submitted = match.away_submitted = True
+                        matches.append(match)
+                games = [map_form.cleaned_data for map_form in self.forms[1] if map_form.cleaned_data.get('map')]
+                with transaction.commit_on_success():
+                    Match.bulk_create_with_games(matches, games)
+                clear_captain_dashboards(set(team_id for match in matches for team_id in (match.home_team_id, match.away_team_id)))
+                clear_open_match_queues([tournament.pk])
+                return matches
         return NewTournamentRoundForm
 
     def form_valid(self, form):
@@ -219,10 +223,19 @@ class MatchListView(TournamentSlugContextView, ListView):
             queryset = queryset.filter(Q(home_team__slug=team) | Q(away_team__slug=team))
         return queryset
 
+    @method_decorator(versioned(lambda request, tournament, **kwargs: [tournament_version_key(tournament)]))
+    def dispatch(self, *args, **kwargs):
+        return super(MatchListView, self).dispatch(*args, **kwargs)
+
 
 class MatchDetailView(ObjectPermissionsCheckMixin, TournamentSlugContextView, DetailView):
     model = Match
-    queryset = Match.objects.select_related('home_team', 'away_team')
+
+    def get_object(self, queryset=None):
+        match = super(MatchDetailView, self).get_object(queryset)
+        team_cache.attach([match], 'home_team', 'away_team')
+        tournament_cache.attach([match], 'tournament')
+        return match
 
     def get_context_data(self, **kwargs):
         context = super(MatchDetailView, self).get_context_data(**kwargs)
@@ -235,6 +248,10 @@ class MatchDetailView(ObjectPermissionsCheckMixin, TournamentSlugContextView, De
             del context['first_vod']
         return context
 
+    @method_decorator(versioned(lambda request, tournament, **kwargs: [match_version_key(kwargs.get('pk')), tournament_version_key(tournament)]))
+    def dispatch(self, *args, **kwargs):
+        return super(MatchDetailView, self).dispatch(*args, **kwargs)
+
     def check_permissions(self):
         if not self.object.published and (not self.request.user.is_authenticated() or not self.request.user.get_profile().is_active(self.kwargs.get('tournament'))):
             raise Http404
@@ -257,21 +274,17 @@ class PlayerAdminView(ListView):
 
     def get_context_data(self, **kwargs):
         context = super(PlayerAdminView, self).get_context_data(**kwargs)
-        if self.request.user.is_superuser:
-            context['team_matches'] = self.match_list
-        else:
-            teams = Team.objects.filter(members__user=self.request.user)
-            context['team_matches'] = self.match_list.filter(Q(home_team__in=teams)
-                                                             | Q(away_team__in=teams))
+        context['team_matches'] = [match for match in self.match_list if self.request.user.is_superuser or match.role]
         return context
 
     def get_queryset(self):
-        self.match_list = (Match.objects.filter(published=False)
-                           .order_by('-creation_date')
-                           .select_related('home_team', 'away_team'))
-        if not self.request.user.is_superuser:
-            self.match_list = self.match_list.filter(tournament__teams__members__user=self.request.user)
-        return self.match_list.filter(home_submitted=True, away_submitted=True)
+        if self.request.user.is_superuser:
+            self.match_list = list(Match.objects.filter(published=False)
+                                                .order_by('-creation_date')
+                                                .select_related('home_team', 'away_team'))
+        else:
+            self.match_list = open_match_queue(self.request.user)
+        return [match for match in self.match_list if match.home_submitted and match.away_submitted]
 
     @method_decorator(login_required)
     def dispatch(self, request, *args, **kwargs):
@@ -286,52 +299,46 @@ class MatchReportView(UpdateView):
     def get_form_class(self):
         match = self.object
         if match.structure == "I":
+            # every form picks from the same two rosters, so load them once for all of them
+            active = list(TeamMembership.objects.filter(team__in=(match.home_team_id, match.away_team_id), active=True).only('char_name', 'team'))
+            home_active = [player for player in active if player.team_id == match.home_team_id]
+            away_active = [player for player in active if player.team_id == match.away_team_id]
+
             class ReportMatchForm(ModelForm):
-                winner = forms.ModelChoiceField(required=False,
-                                                queryset=TeamMembership.objects.all(),
-                                                widget=forms.RadioSelect,
-                                                empty_label="Not played")
-                home_player = forms.ModelChoiceField(required=False, queryset=TeamMembership.objects.filter(team=match.home_team, active=True))
-                away_player = forms.ModelChoiceField(required=False, queryset=TeamMembership.objects.filter(team=match.away_team, active=True))
+                home_player = LoadedModelChoiceField(TeamMembership, home_active, required=False)
+                away_player = LoadedModelChoiceField(TeamMembership, away_active, required=False)
 
                 def __init__(self, *args, **kwargs):
                     super(ReportMatchForm, self).__init__(*args, **kwargs)
-                    winner_field = self.fields.get('winner')
                     if not self.instance.is_ace:
-                        assert(self.instance.home_player and self.instance.away_player)
-                        #TODO: figure out how to not issue a query since we know the exact set...maybe artificialy spoof a queryset object
-                        winner_field.queryset = winner_field.queryset.filter(pk__in=(self.instance.home_player_id, self.instance.away_player_id,))
-                        winner_field.choices = (("", "Not played"), (self.instance.home_player_id, str(self.instance.home_player)), (self.instance.away_player_id, str(self.instance.away_player)))
+                        assert(self.instance.home_player_id and self.instance.away_player_id)
+                        self.fields['winner'] = LoadedModelChoiceField(TeamMembership, (self.instance.home_player, self.instance.away_player),
+                                                                       required=False,
+                                                                       widget=forms.RadioSelect,
+                                                                       empty_label="Not played")
                         del self.fields['home_player']
                         del self.fields['home_race']
                         del self.fields['away_player']
                         del self.fields['away_race']
                     else:
-                        self.fields['winner'] = forms.ModelChoiceField(required=False,
-                                                                       queryset=TeamMembership.objects.filter(active=True, team__pk__in=(match.home_team_id, match.away_team_id,)),
-                                                                       empty_label="Not played"
-                                                                       )
+                        self.fields['winner'] = LoadedModelChoiceField(TeamMembership, active,
+                                                                       required=False,
+                                                                       empty_label="Not played")
 
                 class Meta:
                     model = Game
                     fields = ('replay', 'home_player', 'home_race', 'away_player', 'away_race', 'winner', 'forfeit',)
         else:
             class ReportMatchForm(ModelForm):
-                winner_team = forms.ModelChoiceField(required=False,
-                                                     queryset=Team.objects.all(),
+                winner_team = LoadedModelChoiceField(Team, (match.home_team, match.away_team),
+                                                     required=False,
                                                      widget=forms.RadioSelect,
                                                      empty_label="Not played")
 
-                def __init__(self, *args, **kwargs):
-                    super(ReportMatchForm, self).__init__(*args, **kwargs)
-                    winner_field = self.fields.get('winner_team')
-                    winner_field.queryset = winner_field.queryset.filter(pk__in=(match.home_team_id, match.away_team_id,)).only('name')
-
                 class Meta:
                     model = Game
                     fields = ('replay', 'victory_screen', 'winner_team', 'forfeit')
-        ReportMatchForm.queryset = Game.objects.select_related('map', 'home_player', 'away_player')
-        form_classes = SortedDict([("Games", inlineformset_factory(Match, Game, extra=0, can_delete=False, form=ReportMatchForm)),
+        form_classes = SortedDict([("Games", inlineformset_factory(Match, Game, formset=GameReportFormSet, extra=0, can_delete=False, form=ReportMatchForm)),
                                    ("Match", modelform_factory(Match, fields=('description',)))])
         return type("MatchReportForm", (MultipleFormSetBase,),
                     {"form_classes": form_classes})
@@ -380,7 +387,7 @@ class SubmitLineupView(ObjectPermissionsCheckMixin, UpdateView):
             side = "home"
         else:
             side = "away"
-        queryset = TeamMembership.objects.filter(team=self.team, active=True)
+        queryset = TeamMembership.objects.choice().filter(team=self.team, active=True)
         if self.team.tournament.structure == "I":
             queryset = queryset.filter(char_code__isnull=False)
         player = forms.ModelChoiceField(queryset=queryset, label='Player')
@@ -412,9 +419,7 @@ class SubmitLineupView(ObjectPermissionsCheckMixin, UpdateView):
             self.object.away_submitted = True
         self.object.save()
         if notification and self.object.home_submitted and self.object.away_submitted:
-            notification.send(User.objects.exclude(username='master').filter(profile__teams__pk__in=(self.object.home_team_id, self.object.away_team_id)),
-                              "tournaments_lineup_ready",
-                              {'match': self.object})
+            send_task("tournaments.tasks.notify_lineup_ready", [self.object.pk])
         messages.success(self.request, 'Lineup submission successful.')
         return super(SubmitLineupView, self).form_valid(*args, **kwargs)
 
@@ -0,0 +1,191 @@
+"""HTTP fetching for the scrapers: a bounded pool of threads that each keep
+their connections open, in front of a content addressed response cache.
+
+    fetcher = Fetcher("/tmp/scrape", workers=8)
+    fetcher.prefetch(urls)      # fetched concurrently into the cache
+    body = fetcher.get(url)     # read back from the cache
+
+Responses are stored under ``objects/`` by the sha1 of their body, and
+``urls/`` maps the sha1 of each url to its status and body hash, so a body
+served at many urls is stored once. A rerun only goes to the network for
+urls it has not seen, and for urls asked for ``fresh`` (pages that change,
+which are fetched once per fetcher). An offline fetcher never does."""
+import hashlib
+import httplib
+import json
+import os
+import socket
+import tempfile
+import threading
+import urllib
+import urlparse
+from functools import partial
+from multiprocessing.pool import ThreadPool
+
+MAX_REDIRECTS = 5
+
+
+class FetchError(IOError):
+    """The url could not be fetched. ``status`` is the HTTP status, or None
+    when there was no response (or, offline, nothing in the cache)."""
+    def __init__(self, url, status=None, reason=""):
+        super(FetchError, self).__init__("{0} {1}".format(url, status or reason))
+        self.url = url
+        self.status = status
+
+
+def sha1(data):
+    return hashlib.sha1(data).hexdigest()
+
+
+class Fetcher(object):
+    def __init__(self, cache_dir=None, workers=8, offline=False, timeout=30):
+        """Without ``cache_dir`` the responses are only kept in memory."""
+        if offline and not cache_dir:
+            raise ValueError("Fetching offline needs a cache directory")
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.offline = offline
+        self.timeout = timeout
+        self.memory = {}
+        self.fetched = set()  # urls fetched by this fetcher, which are fresh enough
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        if cache_dir:
+            for name in ("urls", "objects"):
+                path = os.path.join(cache_dir, name)
+                if not os.path.isdir(path):
+                    os.makedirs(path)
+
+    def get(self, url, fresh=False):
+        """Returns the body of url, from the cache if it is there and ``fresh``
+        is not asked for. Raises FetchError for error statuses (which are
+        cached too) and network errors."""
+        entry = self._cached(url, fresh)
+        if entry is None:
+            if self.offline:
+                raise FetchError(url, reason="not cached")
+            entry = self._store(url, *self._download(url))
+        status, body = entry
+        if status != 200:
+            raise FetchError(url, status)
+        return body
+
+    def prefetch(self, urls, fresh=False):
+        """Fetches the urls that are not cached yet (or all of them, if
+        ``fresh``) concurrently. Errors are left for ``get`` to raise when the
+        url is asked for."""
+        urls = [url for url in set(urls) if url and self._cached(url, fresh) is None]
+        if not urls or self.offline:
+            return
+        pool = ThreadPool(min(self.workers, len(urls)))
+        try:
+            for url in pool.imap_unordered(partial(self._prefetch, fresh=fresh), urls):
+                pass
+        finally:
+            pool.close()
+            pool.join()
+
+    def _prefetch(self, url, fresh=False):
+        try:
+            self.get(url, fresh)
+        except IOError:
+            pass
+        return url
+
+    def _download(self, url):
+        """Returns (status, body), following redirects"""
+        for redirect in range(MAX_REDIRECTS + 1):
+            status, headers, body = self._request(url)
+            if status in (301, 302, 303, 307) and headers.get('location'):
+                url = urlparse.urljoin(url, headers['location'])
+                continue
+            return status, body
+        raise FetchError(url, reason="too many redirects")
+
+    def _request(self, url):
+        """One GET over this thread's open connection to the host, reconnecting
+        once if the server dropped it in between."""
+        parts = urlparse.urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path = "?".join((path, parts.query))
+        if isinstance(path, unicode):
+            path = urllib.quote(path.encode('utf8'), safe="/%?&=;:@+$,~")
+        for attempt in (1, 2):
+            connection = self._connection(parts.scheme, parts.netloc)
+            try:
+                connection.request("GET", path, headers={"Connection": "keep-alive"})
+                response = connection.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error) as e:
+                connection.close()
+                del self.local.connections[parts.scheme, parts.netloc]
+                if attempt == 2 or isinstance(e, socket.timeout):
+                    raise FetchError(url, reason=repr(e))
+                continue
+            if response.will_close:
+                connection.close()
+                del self.local.connections[parts.scheme, parts.netloc]
+            return response.status, dict(response.getheaders()), body
+
+    def _connection(self, scheme, netloc):
+        connections = getattr(self.local, "connections", None)
+        if connections is None:
+            connections = self.local.connections = {}
+        if (scheme, netloc) not in connections:
+            connection_class = httplib.HTTPSConnection if scheme == "https" else httplib.HTTPConnection
+            connections[scheme, netloc] = connection_class(netloc, timeout=self.timeout)
+        return connections[scheme, netloc]
+
+    def _cached(self, url, fresh=False):
+        """Returns the cached (status, body) of url, or None"""
+        if fresh and not self.offline and url not in self.fetched:
+            return None
+        if url in self.memory:
+            return self.memory[url]
+        if not self.cache_dir:
+            return None
+        try:
+            with open(self._url_path(url)) as f:
+                entry = json.load(f)
+            body = ""
+            if entry['object']:
+                with open(self._object_path(entry['object']), 'rb') as f:
+                    body = f.read()
+        except (IOError, ValueError, KeyError):
+            return None
+        return entry['status'], body
+
+    def _store(self, url, status, body):
+        with self.lock:
+            self.fetched.add(url)
+        if status >= 500:  # worth another try on the next run
+            return status, body
+        if not self.cache_dir:
+            self.memory[url] = status, body
+            return status, body
+        digest = sha1(body) if body else None
+        if digest and not os.path.exists(self._object_path(digest)):
+            self._write(self._object_path(digest), body)
+        self._write(self._url_path(url), json.dumps({'url': url, 'status': status, 'object': digest}))
+        return status, body
+
+    def _write(self, path, data):
+        # written aside and renamed, so an interrupted run never leaves a partial entry
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:  # made by another thread meanwhile
+                pass
+        fd, temp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(temp, path)
+
+    def _url_path(self, url):
+        return os.path.join(self.cache_dir, "urls", sha1(url.encode('utf8') if isinstance(url, unicode) else url))
+
+    def _object_path(self, digest):
+        return os.path.join(self.cache_dir, "objects", digest[:2], digest[2:])
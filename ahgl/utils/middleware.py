@@ -1,7 +1,20 @@
+import os.path
+
 from django.contrib.redirects.models import Redirect
 from django import http
 from django.conf import settings
 from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+
+
+def frozen_file(root, path):
+    """Returns where the frozen copy of the page at ``path`` lives under ``root``,
+    or None if the path would escape ``root``."""
+    root = os.path.abspath(root)
+    filename = os.path.normpath(os.path.join(root, path.strip('/'), 'index.html'))
+    if not filename.startswith(root + os.sep):
+        return None
+    return filename
 
 
 class RedirectFallbackMiddleware(object):
@@ -37,3 +50,28 @@ class RedirectFallbackMiddleware(object):
 
         # No redirect was found. Return the response.
         return response
+
+
+class FrozenPageMiddleware(object):
+    """Serves pages written by the freeze_tournament command straight from disk,
+    skipping the views and the rest of the middleware. Only anonymous GET
+    requests without a query string are served, like the anonymous page cache."""
+    def __init__(self):
+        self.root = getattr(settings, 'FROZEN_PAGES_ROOT', None)
+        if not self.root:
+            raise MiddlewareNotUsed
+
+    def process_request(self, request):
+        if (request.method != 'GET' or request.GET
+                or settings.SESSION_COOKIE_NAME in request.COOKIES
+                or request.META.get('HTTP_X_FROZEN_BYPASS')):
+            return None
+        filename = frozen_file(self.root, request.path)
+        if filename is None:
+            return None
+        try:
+            with open(filename, 'rb') as f:
+                content = f.read()
+        except IOError:
+            return None
+        return http.HttpResponse(content, content_type="text/html; charset=utf-8")
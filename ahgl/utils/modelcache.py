@@ -0,0 +1,110 @@
+from hashlib import md5
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import models
+from django.db.models.signals import post_save, post_delete
+
+MODEL_CACHE_SECONDS = getattr(settings, 'MODEL_CACHE_SECONDS', 60 * 60 * 24)
+
+
+class ModelCache(object):
+    """Read-through cache for single rows of small, rarely written models.
+
+    Rows are stored by primary key. Each entry of ``lookups`` is a tuple of
+    field names that uniquely identify a row (e.g. ``('tournament', 'slug')``)
+    and is stored as a pointer to the primary key. Entries are dropped per row
+    from post_save/post_delete, so queryset.update() callers must call
+    ``invalidate_pks`` themselves."""
+
+    def __init__(self, model, lookups=(), timeout=MODEL_CACHE_SECONDS):
+        self.model = model
+        self.lookups = [tuple(sorted(lookup)) for lookup in lookups]
+        self.timeout = timeout
+        self.prefix = ":".join(("modelcache", model._meta.app_label, model._meta.module_name))
+        post_save.connect(self._receiver, sender=model, weak=False,
+                          dispatch_uid="_".join((self.prefix, "saved")))
+        post_delete.connect(self._receiver, sender=model, weak=False,
+                            dispatch_uid="_".join((self.prefix, "deleted")))
+
+    def _key(self, fields, values):
+        values = u"|".join(unicode(value.pk if isinstance(value, models.Model) else value) for value in values)
+        return ":".join((self.prefix, "-".join(fields), md5(values.encode('utf-8')).hexdigest()))
+
+    def _pk_key(self, pk):
+        return self._key(('pk',), (pk,))
+
+    def _lookup_keys(self, obj):
+        return [self._key(lookup, [getattr(obj, self.model._meta.get_field(name).attname) for name in lookup])
+                for lookup in self.lookups]
+
+    def _matches(self, obj, lookup):
+        return all(unicode(getattr(obj, self.model._meta.get_field(name).attname)) ==
+                   unicode(value.pk if isinstance(value, models.Model) else value)
+                   for name, value in lookup.iteritems())
+
+    def get(self, **kwargs):
+        """Like ``Model.objects.get`` for ``pk=`` or one of the declared lookups.
+        Raises ``DoesNotExist`` when there is no such row."""
+        fields = tuple(sorted(kwargs))
+        if fields in (('pk',), (self.model._meta.pk.name,)):
+            return self.get_by_pk(kwargs[fields[0]])
+        if fields not in self.lookups:
+            raise ValueError("{0} is not a cached lookup for {1}".format(fields, self.model.__name__))
+        lookup_key = self._key(fields, [kwargs[name] for name in fields])
+        pk = cache.get(lookup_key)
+        if pk is not None:
+            try:
+                obj = self.get_by_pk(pk)
+            except self.model.DoesNotExist:
+                pass
+            else:
+                if self._matches(obj, kwargs):
+                    return obj
+        obj = self.model._default_manager.get(**kwargs)
+        cache.set_many({self._pk_key(obj.pk): obj, lookup_key: obj.pk}, self.timeout)
+        return obj
+
+    def get_by_pk(self, pk):
+        obj = cache.get(self._pk_key(pk))
+        if obj is None:
+            obj = self.model._default_manager.get(pk=pk)
+            cache.set(self._pk_key(pk), obj, self.timeout)
+        return obj
+
+    def get_many(self, pks):
+        """Returns a dict of primary key to instance, missing rows are left out."""
+        pks = set(pk for pk in pks if pk is not None)
+        keys = dict((self._pk_key(pk), pk) for pk in pks)
+        found = dict((keys[key], obj) for key, obj in cache.get_many(keys.keys()).iteritems())
+        missing = pks.difference(found)
+        if missing:
+            loaded = self.model._default_manager.in_bulk(list(missing))
+            cache.set_many(dict((self._pk_key(pk), obj) for pk, obj in loaded.iteritems()), self.timeout)
+            found.update(loaded)
+        return found
+
+    def attach(self, objects, *field_names):
+        """Fills the given foreign keys of ``objects`` from the cache so
+        that accessing them does not query, instead of select_related."""
+        objects = list(objects)
+        if not objects:
+            return objects
+        fields = [objects[0]._meta.get_field(name) for name in field_names]
+        related = self.get_many(getattr(obj, field.attname) for obj in objects for field in fields)
+        for obj in objects:
+            for field in fields:
+                value = getattr(obj, field.attname)
+                if value in related:
+                    setattr(obj, field.get_cache_name(), related[value])
+        return objects
+
+    def invalidate(self, obj):
+        cache.delete_many([self._pk_key(obj.pk)] + self._lookup_keys(obj))
+
+    def invalidate_pks(self, pks):
+        # lookup pointers are verified on read, so dropping the rows is enough
+        cache.delete_many([self._pk_key(pk) for pk in pks])
+
+    def _receiver(self, sender, instance, **kwargs):
+        self.invalidate(instance)
@@ -0,0 +1,89 @@
+import smtplib
+import socket
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.mail import EmailMessage, get_connection
+from django.core.urlresolvers import reverse
+from django.template import Context
+from django.template.loader import render_to_string
+from django.utils.translation import activate, get_language, ugettext
+
+from notification import models as notification
+from account.models import Account
+
+FORMATS = ("short.txt", "full.txt", "notice.html", "full.html")
+
+
+class EmailsNotSent(Exception):
+    """Sending the emails of ``send_notices`` failed with ``error``. ``user_ids``
+    are the recipients whose email was not sent."""
+    def __init__(self, error, user_ids):
+        super(EmailsNotSent, self).__init__(error, user_ids)
+        self.error = error
+        self.user_ids = user_ids
+
+
+def send_notices(label, recipients, on_site=True, emails_only=False):
+    """Like ``notification.send_now``, for many recipients that each get their
+    own context. ``recipients`` is a list of (user, extra_context). The email
+    settings and languages of all recipients are read with one query each,
+    the notices are inserted together and then the emails go out over one
+    SMTP connection. If sending fails, EmailsNotSent names the recipients
+    still to email, for a retry with ``emails_only`` that does not insert
+    their notices again."""
+    if not recipients:
+        return
+    notice_type = notification.NoticeType.objects.get(label=label)
+    user_ids = [user.pk for user, context in recipients]
+    settings_by_user = dict(notification.NoticeSetting.objects.filter(user__in=user_ids, notice_type=notice_type, medium="1")
+                                                              .values_list('user', 'send'))
+    email_default = notification.NOTICE_MEDIA_DEFAULTS["1"] <= notice_type.default
+    languages = dict(Account.objects.filter(user__in=user_ids).values_list('user', 'language'))
+
+    current_site = Site.objects.get_current()
+    notices_url = u"%s://%s%s" % (getattr(settings, "DEFAULT_HTTP_PROTOCOL", "http"), unicode(current_site),
+                                  reverse("notification_notices"))
+    current_language = get_language()
+    notices, emails = [], []
+    try:
+        for user, extra_context in recipients:
+            if languages.get(user.pk):
+                activate(languages[user.pk])
+            context = Context({
+                "recipient": user,
+                "sender": None,
+                "notice": ugettext(notice_type.display),
+                "notices_url": notices_url,
+                "current_site": current_site,
+            })
+            context.update(extra_context)
+            messages = notification.get_formatted_messages(FORMATS, label, context)
+            if not emails_only:
+                notices.append(notification.Notice(recipient=user, message=messages["notice.html"],
+                                                   notice_type=notice_type, on_site=on_site))
+            if settings_by_user.get(user.pk, email_default) and user.email and user.is_active:
+                subject = "".join(render_to_string("notification/email_subject.txt", {
+                    "message": messages["short.txt"],
+                }, context).splitlines())
+                body = render_to_string("notification/email_body.txt", {
+                    "message": messages["full.txt"],
+                }, context)
+                emails.append((user.pk, EmailMessage(subject, body, settings.DEFAULT_FROM_EMAIL, [user.email])))
+    finally:
+        activate(current_language)
+    if notices:
+        notification.Notice.objects.bulk_create(notices)
+    if not emails:
+        return
+    connection = get_connection(fail_silently=False)
+    sent = 0
+    try:
+        connection.open()
+        for user_id, email in emails:
+            connection.send_messages([email])
+            sent += 1
+    except (smtplib.SMTPException, socket.error) as e:
+        raise EmailsNotSent(e, [user_id for user_id, email in emails[sent:]])
+    finally:
+        connection.close()
@@ -0,0 +1,35 @@
+import random
+
+from django.conf import settings
+from django.core.cache import cache
+
+SAMPLE_CACHE_SECONDS = getattr(settings, 'SAMPLE_CACHE_SECONDS', 60 * 60)
+
+
+def cached_values_list(cache_key, queryset, *fields):
+    """Returns the values_list of ``fields`` for ``queryset``, loading it into
+    the cache on a miss. Whoever changes the rows must delete ``cache_key``."""
+    values = cache.get(cache_key)
+    if values is None:
+        values = list(queryset.values_list(*fields))
+        cache.set(cache_key, values, SAMPLE_CACHE_SECONDS)
+    return values
+
+
+def random_sample(queryset, cache_key, amount):
+    """Picks ``amount`` random rows from ``queryset`` without ORDER BY RANDOM().
+    The primary keys are cached, sampled in python, and only those rows are fetched."""
+    pks = [pk for pk, in cached_values_list(cache_key, queryset, 'pk')]
+    return queryset.filter(pk__in=random.sample(pks, min(amount, len(pks))))
+
+
+def shuffled(queryset, cache_key, order_field=None):
+    """Returns every row of ``queryset`` in a random order. If ``order_field``
+    is given, rows with a true value for it come first, like ``order_by('-field', '?')``."""
+    fields = ('pk', order_field) if order_field else ('pk',)
+    rows = list(cached_values_list(cache_key, queryset, *fields))
+    random.shuffle(rows)
+    if order_field:
+        rows.sort(key=lambda row: not row[1])
+    objects = queryset.in_bulk([row[0] for row in rows])
+    return [objects[row[0]] for row in rows if row[0] in objects]
@@ -0,0 +1,14 @@
+from django.db.models import get_model
+from celery.task import task
+
+from . import thumbnails
+
+
+@task(ignore_result=True)
+def generate_thumbnails(app_label, model_name, pk, names):
+    model = get_model(app_label, model_name)
+    try:
+        instance = model._default_manager.get(pk=pk)
+    except model.DoesNotExist:
+        return
+    thumbnails.generate_thumbnails(instance, names)
@@ -0,0 +1,105 @@
+"""``{% thumbnail %}`` that first reads the thumbnails loaded by ``{% prefetch_thumbnails %}``.
+
+    {% load prefetched_thumbnails %}
+    {% prefetch_thumbnails team_list "photo" "214x120" crop="center" %}
+    {% for team in team_list %}
+        {% thumbnail team.photo "214x120" crop="center" as im %}...{% endthumbnail %}
+    {% endfor %}
+
+The geometry and options must match those of the thumbnail tags for the
+prefetched files to be found. Consecutive prefetches are read together in one
+multi-get when the next thumbnail renders. Without a prefetch it behaves like
+sorl's tag."""
+from django import template
+from django.utils.encoding import smart_str
+
+from sorl.thumbnail import default
+from sorl.thumbnail.conf import settings
+from sorl.thumbnail.templatetags.thumbnail import ThumbnailNode, kw_pat
+
+from utils.thumbnails import prefetch_thumbnails as prefetch, thumbnail_name
+
+register = template.Library()
+
+PREFETCHED = 'prefetched_thumbnails'
+PENDING = 'pending_thumbnails'
+NORESOLVE = {u'True': True, u'False': False, u'None': None}
+
+
+def resolve_options(options, context):
+    resolved = {}
+    for key, expr in options:
+        value = NORESOLVE.get(unicode(expr), expr.resolve(context))
+        if key == 'options':
+            resolved.update(value)
+        else:
+            resolved[key] = value
+    return resolved
+
+
+def lookup(obj, path):
+    for attr in path.split('.'):
+        if obj is None:
+            return None
+        obj = getattr(obj, attr, None)
+    return obj
+
+
+class PrefetchThumbnailsNode(template.Node):
+    def __init__(self, objects, path, geometry, options):
+        self.objects = objects
+        self.path = path
+        self.geometry = geometry
+        self.options = options
+
+    def render(self, context):
+        path, geometry = self.path.resolve(context), self.geometry.resolve(context)
+        options = resolve_options(self.options, context)
+        # kept in the outermost scope so it outlives the with/for blocks the tag may be in
+        context.dicts[0].setdefault(PENDING, []).extend((lookup(obj, path), geometry, options)
+                                                        for obj in self.objects.resolve(context) or ())
+        context.dicts[0].setdefault(PREFETCHED, {})
+        return ''
+
+
+@register.tag
+def prefetch_thumbnails(parser, token):
+    """{% prefetch_thumbnails objects "attribute.path" geometry [key1=val1 ...] %}"""
+    bits = token.split_contents()
+    if len(bits) < 4:
+        raise template.TemplateSyntaxError('Syntax error. Expected: ``prefetch_thumbnails objects path geometry [key1=val1 key2=val2...]``')
+    options = []
+    for bit in bits[4:]:
+        m = kw_pat.match(bit)
+        if not m:
+            raise template.TemplateSyntaxError("Bad option {0}".format(bit))
+        options.append((smart_str(m.group('key')), parser.compile_filter(m.group('value'))))
+    return PrefetchThumbnailsNode(parser.compile_filter(bits[1]), parser.compile_filter(bits[2]), parser.compile_filter(bits[3]), options)
+
+
+class PrefetchedThumbnailNode(ThumbnailNode):
+    def _render(self, context):
+        prefetched, pending = context.get(PREFETCHED), context.get(PENDING)
+        if pending:
+            prefetched.update(prefetch(pending))
+            del pending[:]
+        if not prefetched or settings.THUMBNAIL_DUMMY:
+            return super(PrefetchedThumbnailNode, self)._render(context)
+        file_ = self.file_.resolve(context)
+        if not file_:
+            return self.nodelist_empty.render(context)
+        geometry = self.geometry.resolve(context)
+        options = resolve_options(self.options, context)
+        thumbnail = prefetched.get(thumbnail_name(file_, geometry, options))
+        if thumbnail is None:
+            thumbnail = default.backend.get_thumbnail(file_, geometry, **options)
+        context.push()
+        context[self.as_var] = thumbnail
+        output = self.nodelist_file.render(context)
+        context.pop()
+        return output
+
+
+@register.tag
+def thumbnail(parser, token):
+    return PrefetchedThumbnailNode(parser, token)
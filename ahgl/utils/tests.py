@@ -0,0 +1,173 @@
+import shutil
+import tempfile
+import threading
+from StringIO import StringIO
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from django.core.files.base import ContentFile
+from django.test import SimpleTestCase, TestCase
+
+from tournaments.models import Map
+from . import thumbnails
+from .fetch import Fetcher, FetchError
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serves a body naming the path, 404 under /missing and a redirect at /moved,
+    keeping connections open. Counts requests and connections on the server."""
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path == "/moved":
+            self.send_response(302)
+            self.send_header('Location', "/page/0")
+            body = ""
+        elif self.path.startswith("/missing"):
+            self.send_response(404)
+            body = ""
+        else:
+            self.send_response(200)
+            body = "same" if self.path.startswith("/same") else "page at " + self.path
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FetcherTest(SimpleTestCase):
+    def setUp(self):
+        self.server = StandInServer(('127.0.0.1', 0), StandInHandler)
+        self.server.requests, self.server.connections = [], 0
+        self.base = "http://127.0.0.1:{0}".format(self.server.server_port)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def urls(self, count):
+        return ["{0}/page/{1}".format(self.base, i) for i in range(count)]
+
+    def test_prefetch_reuses_connections(self):
+        fetcher = Fetcher(self.cache_dir, workers=4)
+        fetcher.prefetch(self.urls(40))
+        self.assertEqual(len(self.server.requests), 40)
+        self.assertTrue(self.server.connections <= 4)
+        self.assertEqual(fetcher.get(self.base + "/page/3"), "page at /page/3")
+        self.assertEqual(len(self.server.requests), 40)
+
+    def test_errors_and_redirects(self):
+        fetcher = Fetcher(self.cache_dir)
+        self.assertEqual(fetcher.get(self.base + "/moved"), "page at /page/0")
+        with self.assertRaises(FetchError) as error:
+            fetcher.get(self.base + "/missing")
+        self.assertEqual(error.exception.status, 404)
+        self.assertRaises(IOError, Fetcher(self.cache_dir, offline=True).get, self.base + "/missing")
+
+    def test_offline_replays_the_cache(self):
+        Fetcher(self.cache_dir).prefetch(self.urls(5) + [self.base + "/same/a", self.base + "/same/b"])
+        requests = len(self.server.requests)
+        offline = Fetcher(self.cache_dir, offline=True)
+        offline.prefetch(self.urls(10))
+        self.assertEqual(offline.get(self.base + "/page/4"), "page at /page/4")
+        self.assertEqual(offline.get(self.base + "/same/b"), "same")
+        self.assertRaises(FetchError, offline.get, self.base + "/page/5")
+        self.assertEqual(len(self.server.requests), requests)
+
+    def test_rerun_only_fetches_new_urls(self):
+        Fetcher(self.cache_dir).prefetch(self.urls(5))
+        Fetcher(self.cache_dir).prefetch(self.urls(8))
+        self.assertEqual(len(self.server.requests), 8)
+        fetcher = Fetcher(self.cache_dir)
+        fetcher.prefetch(self.urls(8), fresh=True)
+        self.assertEqual(len(self.server.requests), 16)
+        # once per fetcher
+        self.assertEqual(fetcher.get(self.base + "/page/0", fresh=True), "page at /page/0")
+        self.assertEqual(len(self.server.requests), 16)
+        Fetcher(self.cache_dir).get(self.base + "/page/0", fresh=True)
+        self.assertEqual(len(self.server.requests), 17)
+
+
+class QueueThumbnailsTest(TestCase):
+    def setUp(self):
+        self.sent = []
+        self.old_send_task = thumbnails.send_task
+        thumbnails.send_task = lambda name, args: self.sent.append(args)
+
+    def tearDown(self):
+        thumbnails.send_task = self.old_send_task
+
+    def test_only_new_files_queue(self):
+        Map.objects.create(name="Metalopolis", photo="map_photos/metalopolis.jpg")
+        self.assertEqual(self.sent, [["tournaments", "Map", "Metalopolis", ["photo"]]])
+        map = Map.objects.get(pk="Metalopolis")
+        map.save()
+        self.assertEqual(len(self.sent), 1)
+        map.photo = "map_photos/metalopolis_v2.jpg"
+        map.save()
+        map.save()
+        self.assertEqual(len(self.sent), 2)
+        Map.objects.create(name="Shakuras Plateau")
+        self.assertEqual(len(self.sent), 2)
+
+
+class PrefetchThumbnailsTest(TestCase):
+    """prefetch_thumbnails reads sorl's key value store entries directly, so
+    this breaks if an upgrade of sorl changes their keys or format"""
+    spec = ("214x120", {'crop': "center"})
+
+    def setUp(self):
+        try:
+            from PIL import Image
+        except ImportError:
+            import Image
+        self.old_send_task = thumbnails.send_task
+        thumbnails.send_task = lambda name, args: None
+        photo = StringIO()
+        Image.new("RGB", (920, 450)).save(photo, "PNG")
+        self.map = Map(name="Metalopolis")
+        self.map.photo.save("prefetch_test.png", ContentFile(photo.getvalue()))
+
+    def tearDown(self):
+        from sorl.thumbnail import delete
+        delete(self.map.photo)
+        thumbnails.send_task = self.old_send_task
+
+    def test_reads_what_get_thumbnail_stored(self):
+        from sorl.thumbnail import get_thumbnail
+        geometry, options = self.spec
+        thumbnail = get_thumbnail(self.map.photo, geometry, **options)
+        with self.assertNumQueries(0):
+            prefetched = thumbnails.prefetch_thumbnails([(self.map.photo, geometry, options), (None, geometry, options)])
+        name = thumbnails.thumbnail_name(self.map.photo, geometry, options)
+        self.assertEqual(prefetched.keys(), [name])
+        self.assertEqual(prefetched[name].name, thumbnail.name)
+        self.assertEqual(prefetched[name].size, thumbnail.size)
+        self.assertEqual(prefetched[name].url, thumbnail.url)
+
+    def test_other_sorl_versions_are_not_read(self):
+        from sorl.thumbnail import get_thumbnail
+        geometry, options = self.spec
+        get_thumbnail(self.map.photo, geometry, **options)
+        old_versions = thumbnails.PREFETCH_SORL_VERSIONS
+        thumbnails.PREFETCH_SORL_VERSIONS = ()
+        try:
+            self.assertEqual(thumbnails.prefetch_thumbnails([(self.map.photo, geometry, options)]), {})
+        finally:
+            thumbnails.PREFETCH_SORL_VERSIONS = old_versions
@@ -0,0 +1,103 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models.signals import post_init, post_save
+
+from celery.execute import send_task
+
+# model -> {field name: ((geometry, options), ...)}
+THUMBNAIL_SPECS = {}
+# the sorl-thumbnail releases whose private thumbnail naming and key value
+# store format thumbnail_name and prefetch_thumbnails were written against
+PREFETCH_SORL_VERSIONS = ('11.12',)
+
+
+def pregenerate(model, **fields):
+    """Registers the thumbnails the templates ask for of each image field of
+    ``model``, as ``field=((geometry, options), ...)``. The geometry and options
+    must match the ``{% thumbnail %}`` tags exactly so the pregenerated files
+    are the ones the tags look up. Saving an instance with a new file in one of
+    the fields queues the generation."""
+    if "sorl.thumbnail" not in settings.INSTALLED_APPS:
+        return
+    THUMBNAIL_SPECS[model] = fields
+    dispatch_uid = "_".join(("thumbnails", model._meta.app_label, model._meta.module_name))
+    post_init.connect(remember_files, sender=model, weak=False, dispatch_uid=dispatch_uid)
+    post_save.connect(queue_thumbnails, sender=model, weak=False, dispatch_uid=dispatch_uid)
+
+
+def file_names(sender, instance):
+    """The file name in each registered field of instance, read without
+    building the field files"""
+    return dict((name, getattr(instance.__dict__.get(name), 'name', instance.__dict__.get(name)))
+                for name in THUMBNAIL_SPECS[sender])
+
+
+def remember_files(sender, instance, **kwargs):
+    instance._thumbnail_files = file_names(sender, instance)
+
+
+def queue_thumbnails(sender, instance, created=False, raw=False, **kwargs):
+    if raw:
+        return
+    saved = file_names(sender, instance)
+    previous = {} if created else getattr(instance, '_thumbnail_files', {})
+    instance._thumbnail_files = saved
+    names = [name for name, file_name in saved.iteritems() if file_name and file_name != previous.get(name)]
+    if names:
+        send_task("utils.tasks.generate_thumbnails", [sender._meta.app_label, sender._meta.object_name, instance.pk, names])
+
+
+def generate_thumbnails(instance, names):
+    """Creates the registered thumbnails of the named fields of instance. Ones
+    already in the thumbnail store are only looked up."""
+    from sorl.thumbnail import get_thumbnail
+    specs = THUMBNAIL_SPECS[type(instance)]
+    for name in names:
+        image = getattr(instance, name)
+        if not image:
+            continue
+        for geometry, options in specs[name]:
+            get_thumbnail(image, geometry, **options)
+
+
+def thumbnail_name(image, geometry, options):
+    """The file name sorl gives the thumbnail of image, filling in the backend's
+    default options the same way ``get_thumbnail`` does."""
+    from sorl.thumbnail import default
+    from sorl.thumbnail.conf import settings as sorl_settings, defaults
+    from sorl.thumbnail.images import ImageFile
+    options = dict(options)
+    for key, value in default.backend.default_options.iteritems():
+        options.setdefault(key, value)
+    for key, attr in default.backend.extra_options:
+        value = getattr(sorl_settings, attr)
+        if value != getattr(defaults, attr):
+            options.setdefault(key, value)
+    return default.backend._get_thumbnail_filename(ImageFile(image), geometry, options)
+
+
+def prefetch_thumbnails(specs):
+    """Looks up the thumbnails of ``specs``, an iterable of (image, geometry,
+    options), with a single multi-get on the cache behind sorl's key value
+    store. Returns a dict of thumbnail name (see ``thumbnail_name``) to image
+    file. Empty images are skipped and thumbnails that are not cached are left
+    out, so their ``{% thumbnail %}`` tags look them up (or create them) as usual.
+    Only the default cached_db key value store of the sorl releases in
+    ``PREFETCH_SORL_VERSIONS`` is read this way; otherwise nothing is prefetched
+    and the tags fall back to sorl's own lookups."""
+    import sorl
+    from sorl.thumbnail.conf import settings as sorl_settings
+    if (getattr(sorl, '__version__', None) not in PREFETCH_SORL_VERSIONS
+            or sorl_settings.THUMBNAIL_KVSTORE != 'sorl.thumbnail.kvstores.cached_db_kvstore.KVStore'):
+        return {}
+    from sorl.thumbnail import default
+    from sorl.thumbnail.images import ImageFile, deserialize_image_file
+    from sorl.thumbnail.kvstores.base import add_prefix
+    keys = {}
+    for image, geometry, options in specs:
+        if image:
+            name = thumbnail_name(image, geometry, options)
+            keys[add_prefix(ImageFile(name, default.storage).key)] = name
+    return dict((keys[key], deserialize_image_file(value))
+                for key, value in cache.get_many(keys.keys()).iteritems()
+                if isinstance(value, basestring))
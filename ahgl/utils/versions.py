@@ -0,0 +1,48 @@
+from django.conf import settings
+from django.core.cache import cache
+from django.utils import timezone
+from django.views.decorators.http import condition
+
+VERSION_CACHE_SECONDS = getattr(settings, 'VERSION_CACHE_SECONDS', 60 * 60 * 24 * 30)
+
+
+def version_key(kind, *ids):
+    return ":".join(("data_version", kind) + tuple(unicode(i) for i in ids))
+
+
+def bump_versions(*keys):
+    """Marks the data behind ``keys`` as changed now."""
+    now = timezone.now()
+    cache.set_many(dict((key, now) for key in keys), VERSION_CACHE_SECONDS)
+
+
+def get_versions(keys):
+    """Returns a dict of key to the time it last changed. Unknown versions
+    (never bumped, evicted or cleared on deploy) start over at now."""
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        now = timezone.now()
+        cache.set_many(dict((key, now) for key in missing), VERSION_CACHE_SECONDS)
+        versions.update((key, now) for key in missing)
+    return versions
+
+
+def versioned(keys_func):
+    """Like ``condition``, but the ETag and Last-Modified of the page come from
+    the data versions returned by ``keys_func(request, *args, **kwargs)``, so a
+    304 costs a single cache read. Requests with a session are left alone since
+    their pages also show per user data."""
+    def last_modified(request, *args, **kwargs):
+        if settings.SESSION_COOKIE_NAME in request.COOKIES:
+            return None
+        if not hasattr(request, '_data_version'):
+            request._data_version = max(get_versions(keys_func(request, *args, **kwargs)).values())
+        return request._data_version
+
+    def etag(request, *args, **kwargs):
+        changed = last_modified(request, *args, **kwargs)
+        if changed is None:
+            return None
+        return changed.strftime("%Y%m%d%H%M%S%f")
+    return condition(etag_func=etag, last_modified_func=last_modified)